@@ -13,25 +13,31 @@
 
 # import the necessary packages
 import argparse
+import asyncio
+import contextlib
 import getpass
 import os
 import pathlib
 import shutil
 import time
 from datetime import datetime
-from datetime import timedelta
 import sys
 import csv
 import re
+import json
+import io
+import hashlib
+import heapq
+import itertools
+import random
+import socket
+import sqlite3
 from threading import Thread
 import threading
-from queue import Queue, Empty
-import requests
-import tableauserverclient as TSC
-from tableauserverclient.models import ServerInfoItem
-from wand.image import Image
-from pandas import read_csv, DataFrame
-import pandas as pd
+from queue import Queue, PriorityQueue, Empty
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait
+# tableauserverclient, Wand, pandas and numpy are imported where they are used, so a run only loads what its modes
+# need and --role merge / export load none of them
 import logging
 import logging.handlers
 import log
@@ -39,9 +45,9 @@ import inspect
 import math
 
 # suppress SSL certificate warnings
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
+import urllib3
 
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 os.environ['MAGICK_HOME'] = os.path.abspath('.')
 
@@ -53,8 +59,8 @@ def main():
     path = os.path.dirname(os.path.abspath(filename))
 
     parser = argparse.ArgumentParser(description='Query View Image From Server')
-    parser.add_argument('--sa', required=True, help='Server A URL (the target/new version of Tableau Server)')
-    parser.add_argument('--sb', required=True, help='Server B URL (the old version of Tableau Server)')
+    parser.add_argument('--sa', required=False, help='Server A URL (the target/new version of Tableau Server)')
+    parser.add_argument('--sb', required=False, help='Server B URL (the old version of Tableau Server)')
     parser.add_argument('--si', required=False, help='(optional) Site Name Filter')
     parser.add_argument('--pi', required=False, help='(optional) Project Name Filter')
     parser.add_argument('--wi', required=False, help='(optional) Workbook Name Filter')
@@ -68,27 +74,137 @@ def main():
                         help='(optional) Compare views by based on summary data exports')
     parser.add_argument('--cm', required=False, default='absolute',
                         help="(optional) Compare metrics type for visual comparisons. Default value: 'peak_signal_to_noise_ratio'. Possible values: 'undefined', 'absolute', 'mean_absolute', 'mean_error_per_pixel', 'mean_squared', 'normalized_cross_correlation', 'peak_absolute', 'peak_signal_to_noise_ratio', 'perceptual_hash', 'root_mean_square'")
+    parser.add_argument('--pixel-hash', required=False, action='store_true',
+                        help='(optional) When two PNG renders are not byte-identical, compare a hash of their decoded pixels before running the --cm compare')
+    parser.add_argument('--in-memory', required=False, action='store_true',
+                        help='(optional) Hand rendered bytes straight to the compare instead of writing and re-reading them. Renders are only written to disk for differences and errors, unless --keep-renders is set')
+    parser.add_argument('--keep-renders', required=False, action='store_true',
+                        help='(optional) With --in-memory, still write every render to disk')
+    parser.add_argument('--artifact-store', required=False, action='store_true',
+                        help='(optional) Save each unique render and diff once in objects/ in --f, named by its SHA-256, with artifacts.jsonl mapping the usual paths to them. Image diffs of --compare-engine numpy are cropped to the changed region. Use --role export to lay out the usual folders afterwards')
+    parser.add_argument('--baseline-cache', required=False,
+                        help='(optional) Folder (outside --f) to keep the server B renders in. A later run reuses the render of a server B view that has not been updated since, so only server A is rendered live')
+    parser.add_argument('--baseline-max-age', required=False, type=float,
+                        help='(optional) Hours a --baseline-cache render stays valid, for views whose data changes without the view being updated (extract refreshes, live connections). Default: until the view is updated')
+    parser.add_argument('--refresh-baseline', required=False, action='store_true',
+                        help='(optional) With --baseline-cache, render server B live and in sync with server A as usual, and keep the new renders in the cache')
+    parser.add_argument('--compare-engine', required=False, default='wand', choices=['wand', 'numpy'],
+                        help="(optional) Image compare engine. 'wand' (default) uses ImageMagick, 'numpy' computes the --cm metric with NumPy (requires Pillow)")
+    parser.add_argument('--phash', required=False, action='store_true',
+                        help='(optional) Triage PNG pairs by perceptual hash before comparing them. Only structural differences get a full compare and retries (requires Pillow)')
+    parser.add_argument('--phash-threshold', required=False, type=int, default=5,
+                        help='(optional) Largest perceptual hash distance (0-64 bits) between two renders that --phash treats as a cosmetic difference. Default value: 5')
+    parser.add_argument('--tile-size', required=False, type=int, default=0,
+                        help='(optional) With --compare-engine numpy, compare images in tiles of this many pixels square, skipping identical tiles and writing cropped diffs of the changed regions. Default value: 0 (compare whole images)')
+    parser.add_argument('--early-exit', required=False, type=float,
+                        help='(optional) With --tile-size, stop comparing an image once more than this share (0-1) of its tiles has changed')
+    parser.add_argument('--csv-engine', required=False, default='pandas', choices=['pandas', 'hash'],
+                        help="(optional) CSV compare engine. 'pandas' (default) sorts and compares both DataFrames, 'hash' diffs the rows of both CSVs as multisets of row hashes, reading them in chunks")
+    parser.add_argument('--csv-chunksize', required=False, type=int, default=100000,
+                        help='(optional) Rows read at a time by --csv-engine hash. Default value: 100000')
+    parser.add_argument('--compare-workers', required=False, type=int, default=0,
+                        help='(optional) Number of processes that compare rendered pairs, separately from the --nt render threads. Default value: 0 (compare on the render threads)')
     parser.add_argument('--nt', required=False, type=int, default=1, help='(optional) Number of threads to execute')
+    parser.add_argument('--dt', required=False, type=int, default=8,
+                        help='(optional) Number of threads used to list sites, workbooks and views on both servers')
     parser.add_argument('--nr', required=False, type=int, default=3,
                         help='(optional) Number of retries to attempt for found differences')
-    parser.add_argument('--u', required=True, help='Tableau Server Username')
+    parser.add_argument('--quorum', required=False, type=int,
+                        help='(optional) Keep retrying a view pair until this many attempts agree on whether it differs, within --nr retries. Default: stop at the first attempt without differences')
+    parser.add_argument('--backoff', required=False, type=float, default=1,
+                        help='(optional) Base delay in seconds before retrying a failed render. Doubles with each failed attempt, with jitter. Default value: 1')
+    parser.add_argument('--backoff-max', required=False, type=float, default=60,
+                        help='(optional) Maximum delay in seconds before retrying a failed render. Default value: 60')
+    parser.add_argument('--engine', required=False, default='threads', choices=['threads', 'async'],
+                        help="(optional) Render engine. 'threads' renders pairs on --nt worker threads over a shared pool of threads and sessions, 'async' multiplexes all renders on one event loop (requires aiohttp)")
+    parser.add_argument('--server-concurrency', required=False, type=int,
+                        help='(optional) Maximum view pairs rendering at once on each server with --engine async. Defaults to --nt')
+    parser.add_argument('--adaptive-concurrency', required=False, action='store_true',
+                        help='(optional) Adjust the view pairs rendering at once on each server to its render errors and latency, between --concurrency-floor and --concurrency-ceiling')
+    parser.add_argument('--concurrency-floor', required=False, type=int, default=1,
+                        help='(optional) Fewest view pairs rendering at once on a server with --adaptive-concurrency. Default value: 1')
+    parser.add_argument('--concurrency-ceiling', required=False, type=int,
+                        help='(optional) Most view pairs rendering at once on a server with --adaptive-concurrency. Defaults to --nt, or --server-concurrency with --engine async')
+    parser.add_argument('--latency-target', required=False, type=float,
+                        help='(optional) Render request time in seconds above which --adaptive-concurrency backs off a server, as it does for render errors')
+    parser.add_argument('--u', required=False, help='Tableau Server Username')
     parser.add_argument('--p', required=False,
                         help='(optional) Tableau Server Password. USER WILL BE PROMPTED FOR PASSWORD IF NOT PROVIDED')
     parser.add_argument('--f', required=True,
                         help='filepath to save results to. EXISTING FILES IN FILEPATH WILL BE DELETED')
+    parser.add_argument('--role', required=False, default='single', choices=['single', 'coordinator', 'worker', 'merge', 'export'],
+                        help="(optional) 'coordinator' lists and matches the views and writes the pairs in shards to --f. Any number of 'worker' processes sharing --f claim the shards, render and compare them. 'merge' then combines the workers' results into the report. 'export' lays out the renders and diffs of an --artifact-store run in the usual folders of --f. Default value: 'single' (all in one process)")
+    parser.add_argument('--shard-size', required=False, type=int, default=20,
+                        help='(optional) View pairs per shard written by --role coordinator. Default value: 20')
+    parser.add_argument('--worker-id', required=False, default=f'{socket.gethostname()}-{os.getpid()}',
+                        help='(optional) Name of a --role worker, unique across hosts. Default: <hostname>-<process id>')
+    parser.add_argument('--lease-seconds', required=False, type=float, default=120,
+                        help="(optional) Seconds a --role worker's claim on a shard lasts without a heartbeat, before other workers may take the shard over. Default value: 120")
+    parser.add_argument('--run-id', required=False,
+                        help="(optional) Id of a coordinator/worker run. --role coordinator writes it to --f/shards/run (default: a timestamp), and a --role worker given one only works on that run. A worker without one joins the run in --f unless it is already finished, and otherwise waits for the next")
+    parser.add_argument('--resume', required=False, action='store_true',
+                        help='(optional) Resume the last run in --f instead of deleting it, skipping view pairs it already finished')
+    parser.add_argument('--incremental', required=False, action='store_true',
+                        help='(optional) Skip view pairs that had no differences in a previous run into --f and have not been updated on either server since')
+    parser.add_argument('--report-format', required=False, default='csv', choices=['csv', 'ndjson', 'parquet'],
+                        help="(optional) Format of the report in --f. 'parquet' requires pyarrow. Default value: 'csv'")
+    parser.add_argument('--task-store', required=False, default='memory', choices=['memory', 'sqlite'],
+                        help="(optional) Where tasks and results are kept. 'sqlite' keeps them in tabcompare.db in --f, which can be queried during the run and lets --resume pick up unfinished tasks. The report is exported from it at the end. Default value: 'memory'")
+    parser.add_argument('--schedule', required=False, default='discovery', choices=['discovery', 'cost'],
+                        help="(optional) Order in which queued view pairs are compared. 'cost' compares the pairs that took longest in earlier reports first, so slow dashboards don't hold up the end of the run. Default value: 'discovery' (in the order they are found)")
+    parser.add_argument('--history', required=False, nargs='*',
+                        help='(optional) Reports of earlier runs that --schedule cost estimates render and compare times from. Default: the report of the last run in --f')
+    parser.add_argument('--priority-list', required=False,
+                        help='(optional) Compare these first, in this order: path to a csv with workbook content URLs, view content URLs or view LUIDs in its first column')
+    parser.add_argument('--report-interval', required=False, type=float, default=5,
+                        help='(optional) Seconds between flushes of buffered report rows to disk. Default value: 5')
     parser.add_argument('--l', required=False, type=str, default=os.path.join(path, "logs", "TabCompare"),
                         help='(optional) Log file. Date and ".log" will be appended automatically to allow for rotation.')
     parser.add_argument('--ll', required=False, type=str, default='INFO', choices=['ERROR', 'WARN', 'INFO', 'DEBUG'],
                         help="(optional) Log level. Default value: 'ERROR'. Possible values: 'ERROR', 'WARN', 'INFO', 'DEBUG'")
 
-    global retry_pairs
-    retry_pairs = {}
     global args
     args = parser.parse_args()
+    global retry_policy
+    retry_policy = RetryPolicy(args.nr, args.quorum, args.backoff, args.backoff_max)
     global report_path
-    report_path = os.path.join(args.f, "report.csv")
+    report_path = os.path.join(args.f, f"report.{args.report_format}")
+    # a --role worker keeps its report, manifest and perceptual hash index apart from the other workers sharing --f
+    results_path = os.path.join(args.f, "results", args.worker_id) if args.role == 'worker' else None
+    if results_path:
+        report_path = f"{results_path}.ndjson"
+    global unmatched_path
+    unmatched_path = os.path.join(args.f, "unmatched.csv")
     global task_queue
     task_queue = Queue()
+    global work_tracker
+    work_tracker = WorkTracker()
+    global compare_stats
+    compare_stats = CompareStats()
+    global phash_index
+    results_prefix = f"{results_path}." if results_path else os.path.join(args.f, "")
+    phash_index = PerceptualHashIndex(f"{results_prefix}phash_index.csv", f"{results_prefix}phash_clusters.csv",
+                                      args.phash_threshold) if args.phash else None
+    global artifact_store
+    artifact_store = ArtifactStore(args.f, f"{results_prefix}artifacts.jsonl") \
+        if args.artifact_store and args.role != 'export' else None
+    global task_store
+    task_store = None
+    global shard_worker
+    shard_worker = ShardWorker(args.f, args.worker_id, args.lease_seconds, args.run_id) \
+        if args.role == 'worker' else None
+    global timing_stats
+    timing_stats = TimingStats()
+    global session_pool
+    session_pool = SessionPool(max(args.nt, args.dt))
+    global compare_stage
+    compare_stage = CompareStage(args.compare_workers) if args.compare_workers else None
+    global adaptive_concurrency
+    adaptive_concurrency = None
+    global scheduler
+    scheduler = None
+    global baseline_cache
+    baseline_cache = BaselineCache(args.baseline_cache, args.baseline_max_age) if args.baseline_cache else None
 
     # initialize logging
     log.logger = logging.getLogger()
@@ -96,21 +212,148 @@ def main():
         log.logger = log.LoggerQuickSetup(args.l, log_level=args.ll)
 
     # validate as much as possible before password prompt
-    if not (args.cv or args.cd):
+    if args.role not in ('merge', 'export') and not args.u:
+        log.logger.error('Invalid options. --u is required, except with --role merge or export')
+        exit()
+
+    if args.role in ('single', 'coordinator') and not (args.sa and args.sb):
+        log.logger.error('Invalid options. --sa and --sb are required, except with --role worker, merge or export')
+        exit()
+
+    if args.role in ('single', 'worker') and not (args.cv or args.cd):
         log.logger.error(
             'Invalid options. You must provide either the --cv or --cd argument, or both, to run TabCompare')
         exit()
 
+    if args.role != 'single' and (args.resume or args.incremental):
+        log.logger.error('Invalid options. --resume and --incremental only apply to --role single')
+        exit()
+
+    if args.task_store == 'sqlite' and args.role != 'single':
+        log.logger.error('Invalid options. --task-store sqlite only applies to --role single')
+        exit()
+
+    if args.shard_size < 1 or args.lease_seconds <= 0:
+        log.logger.error('Invalid options. --shard-size and --lease-seconds must be positive')
+        exit()
+
+    if (args.schedule == 'cost' or args.priority_list) and args.role not in ('single', 'worker'):
+        log.logger.error('Invalid options. --schedule cost and --priority-list only apply to --role single or worker')
+        exit()
+
+    if args.priority_list and not os.path.isfile(args.priority_list):
+        log.logger.error(f'Invalid options. --priority-list {args.priority_list} does not exist')
+        exit()
+
+    if args.refresh_baseline and not args.baseline_cache:
+        log.logger.error('Invalid options. --refresh-baseline requires --baseline-cache')
+        exit()
+
+    if args.baseline_cache and (os.path.abspath(args.baseline_cache) == os.path.abspath(args.f) or
+                                os.path.abspath(args.baseline_cache).startswith(os.path.join(os.path.abspath(args.f), ''))):
+        log.logger.error('Invalid options. --baseline-cache must be outside --f, which is cleaned at the start of a run')
+        exit()
+
+    if args.baseline_max_age is not None and args.baseline_max_age <= 0:
+        log.logger.error('Invalid options. --baseline-max-age must be positive')
+        exit()
+
+    if args.quorum is not None and not 1 <= args.quorum <= args.nr + 1:
+        log.logger.error(f'Invalid options. --quorum must be between 1 and --nr + 1 ({args.nr + 1})')
+        exit()
+
+    if (args.cv and args.compare_engine == 'wand' or args.pixel_hash) and args.role in ('single', 'worker'):
+        try:
+            import wand.image
+        except ImportError:
+            log.logger.error('Invalid options. --cv with --compare-engine wand, and --pixel-hash, require Wand and '
+                             'ImageMagick to be installed')
+            exit()
+
+    if args.phash or args.compare_engine == 'numpy':
+        try:
+            import PIL
+        except ImportError:
+            log.logger.error('Invalid options. --phash and --compare-engine numpy require the Pillow package to be installed')
+            exit()
+
+    if args.tile_size:
+        if args.compare_engine != 'numpy' or args.cm not in TILED_COMPARE_METRICS:
+            log.logger.error(f'Invalid options. --tile-size requires --compare-engine numpy and supports --cm '
+                             f'{", ".join(TILED_COMPARE_METRICS)}')
+            exit()
+
+    if args.compare_engine == 'numpy':
+        if args.cm not in NUMPY_COMPARE_METRICS:
+            log.logger.error(f'Invalid options. --compare-engine numpy supports --cm {", ".join(NUMPY_COMPARE_METRICS)}')
+            exit()
+
+    if args.adaptive_concurrency:
+        # more pairs than the render threads can't be in flight, whatever the servers could take
+        max_concurrency = args.nt if args.engine == 'threads' else (args.server_concurrency or args.nt)
+        ceiling = min(args.concurrency_ceiling or max_concurrency, max_concurrency)
+        if not 1 <= args.concurrency_floor <= ceiling:
+            log.logger.error(f'Invalid options. --concurrency-floor must be between 1 and the ceiling ({ceiling})')
+            exit()
+        adaptive_concurrency = AdaptiveConcurrency(args.concurrency_floor, ceiling, args.latency_target)
+
+    if args.report_format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            log.logger.error('Invalid options. --report-format parquet requires the pyarrow package to be installed')
+            exit()
+
+    if args.engine == 'async':
+        try:
+            import aiohttp
+        except ImportError:
+            log.logger.error('Invalid options. --engine async requires the aiohttp package to be installed')
+            exit()
+
     # prompt for password if it is not passed as a command line parameter
     global password
-    if args.p:
+    if args.p or args.role in ('merge', 'export'):
         password = args.p
     else:
         password = getpass.getpass("Tableau Server Password For " + args.u + ":")
     # password="admin"
 
-    # Clean Filepath
-    ret = cleanFilepath(args.f)
+    if args.schedule == 'cost' or args.priority_list:
+        # read the last report before the run in --f is cleaned away
+        history = args.history
+        if history is None:
+            history = [report_path] if os.path.isfile(report_path) else []
+        scheduler = TaskScheduler(history, args.priority_list, args.schedule == 'cost')
+        task_queue = ScheduledQueue(scheduler)
+
+    # Clean Filepath, unless we are picking up where the last run left off or share it with other processes
+    global run_manifest
+    if args.role == 'worker':
+        shard_worker.waitForCoordinator()
+        run_manifest = RunManifest(f"{results_path}.manifest.jsonl")
+        ret = prepareFilepath(args.f)
+        makePath(os.path.join(args.f, "results"))
+    elif args.role == 'merge':
+        run_manifest = None
+        ret = os.path.isdir(os.path.join(args.f, "shards"))
+        if not ret:
+            log.logger.error(f'No shards to merge in {args.f}. Run --role coordinator and workers first')
+    elif args.role == 'export':
+        run_manifest = None
+        ret = os.path.isdir(os.path.join(args.f, "objects"))
+        if not ret:
+            log.logger.error(f'No artifacts to export in {args.f}. Run with --artifact-store first')
+    elif args.resume:
+        run_manifest = RunManifest(os.path.join(args.f, "manifest.jsonl"), resume=True,
+                                   incremental=args.incremental)
+        log.logger.info(f'Resuming run {run_manifest.run_id} in {args.f}')
+        ret = prepareFilepath(args.f)
+    else:
+        run_manifest = RunManifest(os.path.join(args.f, "manifest.jsonl"), incremental=args.incremental)
+        ret = cleanFilepath(args.f)
+        if ret:
+            run_manifest.save()  # earlier runs are still needed for --incremental
 
     # create output report with headers
     output = ['server_a_view_luid',
@@ -139,37 +382,127 @@ def main():
               'diff_filepath',
               'view_render_a_error_text',
               'view_render_b_error_text',
-              'compare_error_text']
-
-    with open(os.path.join(args.f, "report.csv"), 'a+', newline='') as f:
-        writer = ThreadSafeCSVWriter(f)
-        writer.writerow(output)
+              'compare_error_text',
+              'compare_fast_path',
+              'view_render_a_attempt_number',
+              'view_render_b_attempt_number',
+              'verdict',
+              'view_render_a_signin_seconds',
+              'view_render_b_signin_seconds',
+              'view_render_a_wait_seconds',
+              'view_render_b_wait_seconds',
+              'view_render_a_request_seconds',
+              'view_render_b_request_seconds',
+              'view_render_a_bytes_per_second',
+              'view_render_b_bytes_per_second',
+              'view_render_a_write_seconds',
+              'view_render_b_write_seconds',
+              'compare_seconds',
+              'task_seconds',
+              'diff_regions',
+              'compare_early_exit',
+              'phash_distance',
+              'triage',
+              'baseline_cached',
+              'csv_rows_a',
+              'csv_rows_b',
+              'csv_differing_rows']
+
+    if ret and args.role == 'merge':
+        mergeShardResults(output)
+        return
+
+    if ret and args.role == 'export':
+        exportArtifacts()
+        return
+
+    if ret and args.role == 'coordinator':
+        # list and match the views as usual, but leave the pairs to the workers
+        shard_writer = ShardWriter(os.path.join(args.f, "shards"), args.shard_size,
+                                   args.run_id or datetime.now().strftime('%Y%m%d%H%M%S%f'))
+        discoverViews(shard_writer.add)
+        shard_writer.close()
+        session_pool.signOutAll()
+        return
 
     if ret:
-        # get Images from both servers
-        log.logger.debug('getting view list')
-        views_to_compare_a = getViews(args.sa)
-        views_to_compare_b = getViews(args.sb)
-
-        enqueueCompareViewTasks(views_to_compare_a, views_to_compare_b)
-
-        # spin up N threads
-        for index in range(args.nt):
-            threadname = index + 1  # start thread names at 1
-            worker = TaskWorker(threadname, task_queue)
-            log.logger.info('Starting thread with name: {threadname}')
-            worker.start()
-            log.logger.debug(threading.active_count())
-
-        # loop until work is done
-        while 1 == 1:
-            if threading.active_count() == 1:
-                log.logger.info('Worker threads have completed. Exiting')
-                return
-            time.sleep(5)
-            log.logger.info('Waiting on {} worker threads. Currently active threads:: {}'.format(
-                threading.active_count() - 1,
-                threading.enumerate()))
+        # every result goes through one writer thread, so rows are batched and never interleaved. A worker's rows
+        # keep their types in ndjson until the merge writes them in --report-format
+        global report_writer
+        if args.task_store == 'sqlite':
+            # tasks and results go to the database instead of the queue and the report writer
+            task_store = TaskStore(os.path.join(args.f, "tabcompare.db"), output)
+            task_queue = task_store
+            if args.resume:
+                task_store.restore()
+        else:
+            report_writer = ReportWriter(report_path, output,
+                                         'ndjson' if args.role == 'worker' else args.report_format,
+                                         args.report_interval)
+            report_writer.start()
+
+        discovery = None
+        if shard_worker is not None:
+            # take view pairs from the coordinator's shards instead
+            discovery = Thread(target=shard_worker.run, name='Shards')
+        elif task_store is not None and task_store.getMeta('discovery_complete'):
+            log.logger.info('Every view pair was found before the run was interrupted, only unfinished tasks are left')
+            work_tracker.close()
+        else:
+            # get Images from both servers, rendering starts as soon as the first matched pairs are found
+            log.logger.debug('getting view list')
+            discovery = Thread(target=discoverViews, name='Discovery')
+        if discovery is not None:
+            discovery.start()
+
+        try:
+            if args.engine == 'async':
+                log.logger.info('Rendering with the async engine')
+                Thread(target=stopWorkersWhenDone, args=(1,), name='Completion', daemon=True).start()
+                AsyncRenderEngine(args.server_concurrency or args.nt).run(task_queue)
+            else:
+                # renders of both sides of a pair run on this shared pool, see CompareTask.renderViews
+                global render_executor
+                render_executor = ThreadPoolExecutor(2 * args.nt, 'Renderer')
+                workers = []
+                try:
+                    # spin up N threads
+                    for index in range(args.nt):
+                        threadname = index + 1  # start thread names at 1
+                        worker = TaskWorker(threadname, task_queue)
+                        log.logger.info(f'Starting thread with name: {threadname}')
+                        worker.start()
+                        workers.append(worker)
+                        log.logger.debug(threading.active_count())
+
+                    # block until every pair has finished
+                    work_tracker.wait()
+                finally:
+                    # let the workers go, also after Ctrl-C or an error here, so none of them waits on the queue forever
+                    stopWorkers(len(workers))
+                    for worker in workers:
+                        worker.join()
+                    render_executor.shutdown()
+
+            log.logger.info('Worker threads have completed. Exiting')
+        finally:
+            # the rows of the pairs that did finish reach the report either way
+            if compare_stage is not None:
+                compare_stage.shutdown()
+            session_pool.signOutAll()
+            if task_store is not None:
+                task_store.close()
+            else:
+                report_writer.close()
+        compare_stats.logSummary()
+        timing_stats.logSummary()
+        if artifact_store is not None:
+            artifact_store.logSummary()
+        if baseline_cache is not None:
+            baseline_cache.logSummary()
+        if phash_index is not None:
+            phash_index.write()
+        return
 
     # If image comparison finished successfully then display message
     if ret:
@@ -183,6 +516,8 @@ def main():
 
 
 def getSites(serverName):
+    import tableauserverclient as TSC
+
     sites = []
     try:
         # Step 1: Sign in to server.
@@ -227,6 +562,15 @@ def cleanFilepath(filepath):
         log.logger.error(e)
 
 
+def prepareFilepath(filepath):
+    # make sure the output file directory exists, keeping whatever is already in it
+    try:
+        makePath(os.path.join(filepath, "differences"))
+        return True
+    except Exception as e:
+        log.logger.error(e)
+
+
 def getCurrentMicrosecondsStr():
     # get the current microseconds time in a three-digit string
     current_time_microseconds_str = str(datetime.now().microsecond)[:3]
@@ -247,7 +591,7 @@ def roundMixedDataframe(df):
 
 class SiteView(object):
     # simple class that pairs a ViewItem from TSC with its respective site, server, and some convenience methods
-    def __init__(self, view: TSC.ViewItem, site: TSC.SiteItem, server: TSC.Server, server_info: ServerInfoItem):
+    def __init__(self, view: 'TSC.ViewItem', site: 'TSC.SiteItem', server: 'TSC.Server', server_info: 'ServerInfoItem'):
         self.view = view
         self.site = site
         self.server = server
@@ -273,20 +617,30 @@ class SiteView(object):
         return f'{self.server.server_address}/#{site_str}/views/{self.view.content_url.replace("/sheets/", "/")}'
 
 
+# longest a render holding a pooled session waits for the other side of its pair before it starts on its own
+START_BARRIER_SECONDS = 60
+
+
 class ViewRenderer(object):
     # def __init__(self, site_view, render_type, '''filepath,''' attempt_num=0):
-    def __init__(self, site_view, render_type, attempt_num=0):
+    def __init__(self, site_view, render_type, attempt_num=0, baseline=False):
         self.site_view = site_view
         self.render_type = render_type
+        self.baseline = baseline  # the server B side of a pair, which --baseline-cache keeps
+        self.cached = False  # restored from --baseline-cache instead of rendered
         self.filepath = ''
         self.attempt_num = attempt_num
-        self.start_timestamp = datetime.now()
+        self.start_barrier = None  # shared with the other side of the pair, so both requests go out together
         self.filesize = 0
         self.duration = 0
         self.start_time = None
         self.succeeded = False
         self.is_complete = False
         self.error_text = ''
+        self.content_hash = ''
+        self.content = None  # the rendered bytes, when --in-memory hands them to the compare instead of the disk
+        self.timings = {}  # wall-clock seconds per phase: signin, wait, request and write, see timePhase
+        self.perf_start_time = time.perf_counter()
 
     def getViewContentUrlClean(self):
         return self.site_view.view.content_url.replace("/sheets/", "~")
@@ -307,64 +661,139 @@ class ViewRenderer(object):
             return (os.path.join(args.f, server_name, self.site_view.getSiteContentUrlString(),
                      self.site_view.workbook_content_url, self.site_view.content_url_clean))
 
-    def getOutputFilePath(self, server_name=None, diff=False):
+    def getOutputFilePath(self, server_name=None, diff=False, attempt_num=None):
         suffix = ''
         if diff:
             suffix = '_diff'
-        return f"{self.getOutputFilePathBase(server_name, diff)}_{self.attempt_num}{suffix}.{self.render_type}"
+        if attempt_num is None:
+            attempt_num = self.attempt_num
+        return f"{self.getOutputFilePathBase(server_name, diff)}_{attempt_num}{suffix}.{self.render_type}"
+
+    def waitForStart(self):
+        # everything since execute() started went into getting a signed-in session
+        self.timings.setdefault('signin', time.perf_counter() - self.perf_start_time)
+
+        # now make the request, once the other side is ready to make its own
+        with timePhase(self.timings, 'wait'):
+            if self.start_barrier is not None:
+                try:
+                    self.start_barrier.wait(START_BARRIER_SECONDS)
+                except threading.BrokenBarrierError:
+                    pass  # the other side failed, or couldn't get a session in time, go ahead on our own
+                self.start_barrier = None  # a retry after an expired session doesn't wait again
+
+        self.start_time = time.strftime('%Y-%m-%d %H:%M:%S.') + getCurrentMicrosecondsStr()
+        self.perf_start_time = time.perf_counter()  # reset the timer so duration only covers the render itself
+
+    def renderImage(self, server):
+        import tableauserverclient as TSC
+
+        image_req_option = TSC.ImageRequestOptions(imageresolution=TSC.ImageRequestOptions.Resolution.High,
+                                                   maxage=0)
+        self.waitForStart()
+        with timePhase(self.timings, 'request'):
+            server.views.populate_image(self.site_view.view, image_req_option)
+            return self.site_view.view.image  # the image is only fetched here
+
+    def renderCsv(self, server):
+        import tableauserverclient as TSC
+
+        csv_req_option = TSC.ImageRequestOptions(maxage=0)  # CSVRequestOption does not support "maxage"
+        self.waitForStart()
+        with timePhase(self.timings, 'request'):
+            server.views.populate_csv(self.site_view.view, csv_req_option)
+            return b''.join(self.site_view.view.csv)  # consume the stream while we still hold the session
 
     def execute(self):
-        process_start_time = time.process_time()
+        self.perf_start_time = time.perf_counter()
         try:
-            tableau_auth = TSC.TableauAuth(args.u, password, site_id=self.site_view.site.content_url)
-            server = TSC.Server(self.site_view.server.server_address)
-            server.add_http_options({'verify': False})
-            server.version = APIVERSION
-
-            makePath(self.getOutputFilePathBase())
-            with server.auth.sign_in(tableau_auth):
-                if self.render_type == 'png':
-                    # TSC something
-                    image_req_option = TSC.ImageRequestOptions(imageresolution=TSC.ImageRequestOptions.Resolution.High,
-                                                               maxage=0)
-
-                    # now make the request, but only at or after the specified time
-                    while datetime.now() < self.start_timestamp:
-                        time.sleep(.05)
-
-                    self.start_time = time.strftime('%Y-%m-%d %H:%M:%S.') + getCurrentMicrosecondsStr()
-                    process_start_time = time.process_time()  # reset the timer so we get the most accurate duration
-                    server.views.populate_image(self.site_view.view, image_req_option)
-                    with open(self.getOutputFilePath(), "wb") as file_to_write:
-                        file_to_write.write(self.site_view.view.image)
-                elif self.render_type == 'csv':
-                    csv_req_option = TSC.ImageRequestOptions(maxage=0)  # CSVRequestOption does not support "maxage"
-
-                    # now make the request, but only at or after the specified time
-                    while datetime.now() < self.start_timestamp:
-                        time.sleep(.05)
-
-                    self.start_time = time.strftime('%Y-%m-%d %H:%M:%S.') + getCurrentMicrosecondsStr()
-                    process_start_time = time.process_time()  # reset the timer so we get the most accurate duration
-                    server.views.populate_csv(self.site_view.view, csv_req_option)
-                    with open(self.getOutputFilePath(), "wb") as file_to_write:
-                        file_to_write.writelines(self.site_view.view.csv)
-                else:
-                    raise RuntimeError(f'Invalid render_type provided, {self.render_type}')
+            if self.render_type == 'png':
+                render = self.renderImage
+            elif self.render_type == 'csv':
+                render = self.renderCsv
+            else:
+                raise RuntimeError(f'Invalid render_type provided, {self.render_type}')
 
-            if os.path.isfile(self.getOutputFilePath()):
-                self.succeeded = True
+            content = session_pool.run(self.site_view.server.server_address, self.site_view.site.content_url, render)
+            with timePhase(self.timings, 'write'):
+                self.save(content)
         except Exception as e:
             self.error_text = f'Error rendering to {self.render_type}: {e}, {sys.exc_info()}'
+            if self.start_barrier is not None:
+                self.start_barrier.abort()  # don't leave the other side waiting for us
             raise e
         finally:
-            self.is_complete = True
-            self.duration = time.process_time() - process_start_time
-            if os.path.isfile(self.getOutputFilePath()):
-                self.filesize = os.stat(self.getOutputFilePath()).st_size
-                self.filepath = self.getOutputFilePath()
-            else:
-                self.error_text += f'File {self.getOutputFilePath()} is missing.'
+            self.complete()
+
+    def save(self, content):
+        self.content_hash = hashlib.sha256(content).hexdigest()
+        if self.baseline and baseline_cache is not None and not self.cached:
+            baseline_cache.store(self, content)
+        if args.in_memory:
+            self.content = content
+            self.succeeded = True
+            return
+
+        if artifact_store is not None:
+            # the report and manifests point at the stored object, see ArtifactStore
+            self.filepath = artifact_store.put(content, self.getOutputFilePath())
+            self.succeeded = True
+            return
+
+        makePath(self.getOutputFilePathBase())
+        with open(self.getOutputFilePath(), "wb") as file_to_write:
+            file_to_write.write(content)
+
+        if os.path.isfile(self.getOutputFilePath()):
+            self.succeeded = True
+
+    def loadFromCache(self):
+        # use the render --baseline-cache kept of this view instead of rendering it, if it is still valid
+        cached = baseline_cache.load(self)
+        if cached is None:
+            return False
+        content, rendered_at = cached
+        self.cached = True
+        self.start_time = rendered_at
+        self.perf_start_time = time.perf_counter()
+        try:
+            with timePhase(self.timings, 'write'):
+                self.save(content)
+        except Exception as e:
+            self.error_text = f'Error restoring cached render to {self.render_type}: {e}, {sys.exc_info()}'
+        finally:
+            self.complete()
+        return True
+
+    def persist(self):
+        # write an in-memory render to where it would have gone on disk
+        with timePhase(self.timings, 'write'):
+            if artifact_store is not None:
+                self.filepath = artifact_store.put(self.content, self.getOutputFilePath())
+                return
+            makePath(self.getOutputFilePathBase())
+            with open(self.getOutputFilePath(), "wb") as file_to_write:
+                file_to_write.write(self.content)
+        self.filepath = self.getOutputFilePath()
+
+    def getThroughput(self):
+        # downloaded bytes per second of the render request
+        if self.filesize and self.timings.get('request'):
+            return self.filesize / self.timings['request']
+        return None
+
+    def complete(self):
+        self.is_complete = True
+        self.duration = time.perf_counter() - self.perf_start_time
+        if self.content is not None:
+            self.filesize = len(self.content)
+        elif self.filepath and os.path.isfile(self.filepath):
+            self.filesize = os.stat(self.filepath).st_size
+        elif os.path.isfile(self.getOutputFilePath()):
+            self.filesize = os.stat(self.getOutputFilePath()).st_size
+            self.filepath = self.getOutputFilePath()
+        else:
+            self.error_text += f'File {self.getOutputFilePath()} is missing.'
 
 
 class CompareTask(object):
@@ -377,10 +806,25 @@ class CompareTask(object):
         self.diff_filepath = diff_filepath
         self.error_text = ''
         self.succeeded = False
+        self.fast_path = None  # set once the renders are compared: 'bytes', 'pixels' or 'phash' when a hash match skipped the compare
+        self.phash_a = None  # perceptual hashes of the PNG renders with --phash, see triagePerceptualHashes
+        self.phash_b = None
+        self.phash_distance = None
+        self.triage = ''  # 'identical', 'cosmetic' or 'structural' with --phash
+        self.verdict = ''  # set on the last attempt at a pair, see RetryPolicy
+        self.diff_regions = ''  # 'x,y,width,height;...' of the changed regions, with --tile-size
+        self.early_exit = False  # --early-exit stopped the compare, difference_value only counts the tiles seen
+        self.csv_rows_a = None  # row counts of both CSVs, and of the rows without a counterpart, with --csv-engine hash
+        self.csv_rows_b = None
+        self.csv_differing_rows = None
+        self.shard = None  # (shard, lease generation) the pair came from with --role worker, see ShardWorker
+        self.task_id = None  # row of the task in the --task-store database
+        self.timings = {}  # wall-clock seconds spent comparing, and on the whole task
+        self.perf_start_time = time.perf_counter()
         self.starttime = time.strftime('%Y-%m-%d %H:%M:%S')
 
-    def output_result(self):
-        output = [self.view_render_a.site_view.view.id,
+    def getResultRow(self):
+        return [self.view_render_a.site_view.view.id,
                   self.view_render_b.site_view.view.id,
                   self.view_render_a.site_view.view.content_url,
                   self.view_render_b.site_view.view.content_url,
@@ -406,27 +850,53 @@ class CompareTask(object):
                   self.diff_filepath,
                   self.view_render_a.error_text,
                   self.view_render_b.error_text,
-                  self.error_text]
+                  self.error_text,
+                  self.fast_path or '',
+                  self.view_render_a.attempt_num,
+                  self.view_render_b.attempt_num,
+                  self.verdict,
+                  self.view_render_a.timings.get('signin'),
+                  self.view_render_b.timings.get('signin'),
+                  self.view_render_a.timings.get('wait'),
+                  self.view_render_b.timings.get('wait'),
+                  self.view_render_a.timings.get('request'),
+                  self.view_render_b.timings.get('request'),
+                  self.view_render_a.getThroughput(),
+                  self.view_render_b.getThroughput(),
+                  self.view_render_a.timings.get('write'),
+                  self.view_render_b.timings.get('write'),
+                  self.timings.get('compare'),
+                  self.timings.get('task'),
+                  self.diff_regions,
+                  self.early_exit,
+                  self.phash_distance,
+                  self.triage,
+                  self.view_render_b.cached,
+                  self.csv_rows_a,
+                  self.csv_rows_b,
+                  self.csv_differing_rows]
+
+    def output_result(self, on_written=None):
+        output = self.getResultRow()
 
         log.logger.debug('writing output')
         log.logger.debug(f'writing this output: {output}')
 
-        with open(report_path, 'a+', newline='') as f:
-            writer = ThreadSafeCSVWriter(f)
-            writer.writerow(output)
+        report_writer.write(output, on_written)
 
-    def compare_images(self, image_a, image_b, compare_metric):
-        if not os.path.exists(image_a):
+    def compare_images(self, image_a, image_b, compare_metric, blob_a=None, blob_b=None):
+        # blob_a / blob_b hold the rendered bytes when they were kept in memory instead of written to image_a / image_b
+        if blob_a is None and not os.path.exists(image_a):
             # image does not exist on serverB
             log.logger.debug(f"Could not find {image_a}")
 
-        if not os.path.exists(image_b):
+        if blob_b is None and not os.path.exists(image_b):
             # image does not exist on serverB
             log.logger.debug(f"Could not find {image_b}")
 
         try:
-            with Image(filename=image_a) as image1:
-                with Image(filename=image_b) as image2:
+            with openImage(image_a, blob_a) as image1:
+                with openImage(image_b, blob_b) as image2:
 
                     log.logger.debug('starting the image magic')
 
@@ -466,11 +936,111 @@ class CompareTask(object):
             self.error_text = errortext
             log.logger.error(errortext)
 
-    def compare_csvs(self, csv_a, csv_b):
-        if not os.path.exists(csv_a):
+    def compare_images_numpy(self, image_a, image_b, compare_metric, blob_a=None, blob_b=None):
+        # same as compare_images, but the metric and the diff image are computed with vectorized NumPy operations
+        try:
+            array_a = loadImageArray(image_a, blob_a)
+            array_b = loadImageArray(image_b, blob_b)
+
+            # if images are different sizes, trim them before comparing, as ImageMagick would
+            if array_a.shape != array_b.shape:
+                log.logger.debug('filesizes are different')
+                array_a = trimImageArray(array_a)
+                array_b = trimImageArray(array_b)
+                log.logger.debug(f'images trimmed. comparing with metric {compare_metric}...')
+
+            regions = None
+            if args.tile_size:
+                difference_value, difference_mask, regions, self.early_exit = compareImageTiles(
+                    array_a, array_b, compare_metric, args.tile_size, args.early_exit)
+            else:
+                difference_value, difference_mask = compareImageArrays(array_a, array_b, compare_metric)
+
+            log.logger.debug(f"{compare_metric}, difference:, {difference_value}")
+            if difference_value == 0:
+                log.logger.debug("The images are the same")
+            else:
+                log.logger.debug(f'saving diff file to {self.diff_filepath}')
+
+                self.difference_value = difference_value
+
+                makePath(pathlib.Path(
+                    self.diff_filepath).parent.resolve())  # make the full path to the file we're trying to write, in case it doesn't exist
+                if regions is None and args.artifact_store:
+                    # only the bounding box of the changed pixels, diff_regions says where it sits in the render
+                    x, y, width, height = maskBoundingBox(difference_mask)
+                    saveDiffImage(array_a[y:y + height, x:x + width], difference_mask[y:y + height, x:x + width],
+                                  self.diff_filepath)
+                    self.diff_regions = f'{x},{y},{width},{height}'
+                elif regions is None:
+                    saveDiffImage(array_a, difference_mask, self.diff_filepath)
+                else:
+                    # a cropped diff per changed region, next to where the full diff would have gone
+                    diff_filepath_base, extension = os.path.splitext(self.diff_filepath)
+                    for index, (x, y, width, height) in enumerate(regions):
+                        saveDiffImage(array_a[y:y + height, x:x + width], difference_mask[y:y + height, x:x + width],
+                                      f'{diff_filepath_base}_{index}{extension}')
+                    self.diff_regions = ';'.join(','.join(str(number) for number in region) for region in regions)
+                log.logger.debug("the images are different")
+        except Exception as e:
+            errortext = f"Error encountered comparing images {image_a}, {image_b}: {e}, {sys.exc_info()}"
+            self.error_text = errortext
+            log.logger.error(errortext)
+
+    def compare_csvs_hash(self, csv_a, csv_b, content_a=None, content_b=None):
+        # order-insensitive diff of the rows of both CSVs as multisets, by a hash of each (rounded) row. Both CSVs are
+        # read in --csv-chunksize chunks, once to hash every row and, if they differ, once more to write the rows
+        # without a counterpart to the diff file
+        import pandas as pd
+
+        try:
+            columns_a = readCsvColumns(csv_a, content_a)
+            columns_b = readCsvColumns(csv_b, content_b)
+            columns = [column for column in columns_a if column in columns_b]
+            columns_diff = sorted(set(columns_a) ^ set(columns_b))
+
+            hashes_a = hashCsvFile(csv_a, content_a, columns)
+            hashes_b = hashCsvFile(csv_b, content_b, columns)
+            rows_a, rows_b = len(hashes_a), len(hashes_b)
+            excess = pd.Series(hashes_a).value_counts().sub(pd.Series(hashes_b).value_counts(), fill_value=0)
+            removed = excess[excess > 0]  # rows only on server A, or more times on A than on B
+            added = -excess[excess < 0]
+            differing_rows = int(removed.sum() + added.sum())
+            self.csv_rows_a, self.csv_rows_b, self.csv_differing_rows = rows_a, rows_b, differing_rows
+            log.logger.debug(f'{differing_rows} of {rows_a + rows_b} rows differ, columns on one side only: {columns_diff}')
+
+            if columns_diff:
+                self.difference_value = 1  # every row differs by its columns
+            elif differing_rows:
+                self.difference_value = differing_rows / (rows_a + rows_b)
+
+            if columns_diff or differing_rows:
+                makePath(pathlib.Path(
+                    self.diff_filepath).parent.resolve())  # make the full path to the file we're trying to write, in case it doesn't exist
+                with open(self.diff_filepath, 'w', newline='') as f:
+                    if columns_diff:
+                        f.write(f'# columns on one side only: {", ".join(columns_diff)}\n')
+                    header = True
+                    for side, filepath, content, hashes, wanted in [('a', csv_a, content_a, hashes_a, removed),
+                                                                     ('b', csv_b, content_b, hashes_b, added)]:
+                        for rows in selectCsvRows(filepath, content, columns, hashes, wanted):
+                            rows.insert(0, 'side', side)
+                            rows.to_csv(f, index=False, header=header)
+                            header = False
+        except Exception as e:
+            errortext = f"Error encountered comparing CSVs {csv_a}, {csv_b}: {e}, {sys.exc_info()}"
+            self.error_text = errortext
+            log.logger.error(errortext)
+            raise e
+
+    def compare_csvs(self, csv_a, csv_b, content_a=None, content_b=None):
+        # content_a / content_b hold the rendered bytes when they were kept in memory instead of written to csv_a / csv_b
+        import pandas as pd
+
+        if content_a is None and not os.path.exists(csv_a):
             # csv does not exist from serverA
             log.logger.debug(f"Could not find csv_a {csv_a}")
-        if not os.path.exists(csv_b):
+        if content_b is None and not os.path.exists(csv_b):
             # csv does not exist from serverB
             log.logger.debug(f"Could not find csv_b {csv_b}")
 
@@ -479,13 +1049,13 @@ class CompareTask(object):
 
             # replace with empty data frames if the CSVs are blank / not present
             try:
-                dataframe_a = pd.read_csv(csv_a, thousands=',')
+                dataframe_a = pd.read_csv(csvSource(csv_a, content_a), thousands=',')
                 log.logger.debug('got the csv_a in a dataframe')
             except (pd.errors.EmptyDataError, FileNotFoundError) as e:
                 dataframe_a = pd.DataFrame()
 
             try:
-                dataframe_b = pd.read_csv(csv_b, thousands=',')
+                dataframe_b = pd.read_csv(csvSource(csv_b, content_b), thousands=',')
                 log.logger.debug('got the csv_b in a dataframe')
             except (pd.errors.EmptyDataError, FileNotFoundError) as e:
                 dataframe_b = pd.DataFrame()
@@ -549,75 +1119,677 @@ class CompareTask(object):
             log.logger.error(errortext)
             raise e
 
-    def execute(self):
+    def loadCachedBaseline(self):
+        # with --baseline-cache, server B's side may not need rendering at all
+        if baseline_cache is not None and not args.refresh_baseline and not self.view_render_b.is_complete:
+            if self.view_render_b.loadFromCache():
+                log.logger.debug(f'using the cached render of {self.view_render_b.site_view.view.id}')
+
+    def renderViews(self):
+        # render the sides that still need it on the shared render pool, a retry may reuse the other side's render
+        self.loadCachedBaseline()
+        view_renders = []
+        for side, view_render in [('a', self.view_render_a), ('b', self.view_render_b)]:
+            if view_render.is_complete:
+                log.logger.debug(f'reusing render {side} from attempt {view_render.attempt_num}')
+            else:
+                view_renders.append(view_render)
+
+        # this ensures (hopefully) that our requests run at exactly the same time. Not when both sides render from the
+        # same server and site: their sessions come from the same slots of the session pool, and a side waiting with
+        # one of them could keep the other side from ever getting one
+        session_keys = {(view_render.site_view.server.server_address, view_render.site_view.site.content_url)
+                        for view_render in view_renders}
+        start_barrier = threading.Barrier(len(view_renders)) if len(session_keys) > 1 else None
+        for view_render in view_renders:
+            view_render.start_barrier = start_barrier
+
+        # with --adaptive-concurrency, wait for a slot on both servers so the pair can still start together
+        server_addresses = [view_render.site_view.server.server_address for view_render in view_renders]
+        if adaptive_concurrency is not None:
+            adaptive_concurrency.acquire(server_addresses)
         try:
-
-            # my version
-            # spin up 2 threads
-            render_queue = Queue()
-
-            # this ensures (hopefully) that our requests run at exactly the same time
-            start_timestamp = datetime.now() + timedelta(seconds=1)
-            self.view_render_a.start_timestamp = start_timestamp
-            self.view_render_b.start_timestamp = start_timestamp
-
-            render_queue.put(self.view_render_a)
-            render_queue.put(self.view_render_b)
-
-            threadname_a = f'RendererThread_a_{self.view_render_a.site_view.view.id}'
-            threadname_b = f'RendererThread_b_{self.view_render_b.site_view.view.id}'
-
-            worker_a = TaskWorker(threadname_a, render_queue)
-            worker_b = TaskWorker(threadname_b, render_queue)
-
-            log.logger.debug(f'starting thread a')
-            worker_a.start()
-            log.logger.debug(f'starting thread b')
-            worker_b.start()
-
-            # loop until work is done
-            while not (self.view_render_a.is_complete and self.view_render_b.is_complete):
-                # while set([threadname_a, threadname_b]).intersection(set([thread.name for thread in threading.enumerate()])):
-                outstanding_threads = set([threadname_a, threadname_b]).intersection(
-                    set([thread.name for thread in threading.enumerate()]))
-                log.logger.debug(f'Waiting on threads: {outstanding_threads}')
-                time.sleep(5)
-
-            log.logger.debug(f'finished both threads')
-
-            if self.view_render_a.succeeded and self.view_render_b.succeeded:
-                # both views are rendered, compare them to each other
-
-                if not os.path.exists(self.view_render_a.filepath):
-                    # csv does not exist from serverA
-                    log.logger.debug(f"Could not find csv_a {self.view_render_a.filepath}")
-                if not os.path.exists(self.view_render_b.filepath):
-                    # csv does not exist from serverB
-                    log.logger.debug(f"Could not find csv_b {self.view_render_b.filepath}")
-                if self.view_render_a.render_type == 'png' and self.view_render_b.render_type == 'png':
-                    log.logger.debug(f'comparing pngs {self.view_render_a.filepath} to {self.view_render_b.filepath}')
-                    self.compare_images(self.view_render_a.filepath, self.view_render_b.filepath, self.compare_metric)
-                elif self.view_render_a.render_type == 'csv' and self.view_render_b.render_type == 'csv':
-                    log.logger.debug(f'comparing csvs {self.view_render_a.filepath} to {self.view_render_b.filepath}')
-                    self.compare_csvs(self.view_render_a.filepath, self.view_render_b.filepath)
+            futures = [render_executor.submit(view_render.execute) for view_render in view_renders]
+            wait(futures)
+            for future in futures:
+                if future.exception():
+                    log.logger.error(f'{future.exception()}')
+        finally:
+            if adaptive_concurrency is not None:
+                for view_render in view_renders:
+                    adaptive_concurrency.release(view_render)
+
+        log.logger.debug(f'finished both renders')
+
+    def compareRenders(self):
+        with timePhase(self.timings, 'compare'):
+            self.compareRenderContent()
+
+    def compareRenderContent(self):
+        if self.view_render_a.succeeded and self.view_render_b.succeeded:
+            # both views are rendered, compare them to each other
+
+            path_a = self.view_render_a.filepath or self.view_render_a.getOutputFilePath()
+            path_b = self.view_render_b.filepath or self.view_render_b.getOutputFilePath()
+            if self.view_render_a.content is None and not os.path.exists(path_a):
+                # csv does not exist from serverA
+                log.logger.debug(f"Could not find csv_a {path_a}")
+            if self.view_render_b.content is None and not os.path.exists(path_b):
+                # csv does not exist from serverB
+                log.logger.debug(f"Could not find csv_b {path_b}")
+            self.fast_path = ''
+            if self.view_render_a.render_type != self.view_render_b.render_type:
+                raise RuntimeError(
+                    f'Invalid render_type pairs, A: {self.view_render_a.render_type}, B: {self.view_render_b.render_type}')
+            byte_identical = bool(self.view_render_a.content_hash) and \
+                self.view_render_a.content_hash == self.view_render_b.content_hash
+            if self.view_render_a.render_type == 'png' and args.phash:
+                self.triagePerceptualHashes(path_a, path_b, byte_identical)
+
+            if byte_identical:
+                # byte-identical renders can't differ, no need to decode or compare them
+                log.logger.debug(f'{path_a} and {path_b} are byte-identical')
+                self.fast_path = 'bytes'
+            elif self.view_render_a.render_type == 'png' and args.pixel_hash and \
+                    hashImagePixels(path_a, self.view_render_a.content) == \
+                    hashImagePixels(path_b, self.view_render_b.content):
+                # same pixels, the PNGs only differ in metadata
+                log.logger.debug(f'{path_a} and {path_b} have identical pixels')
+                self.fast_path = 'pixels'
+            elif self.triage in ('identical', 'cosmetic'):
+                # not worth a full compare, or a retry
+                log.logger.debug(f'{path_a} and {path_b} only differ cosmetically, perceptual hash distance '
+                                 f'{self.phash_distance}')
+                self.fast_path = 'phash'
+            elif self.view_render_a.render_type == 'png' and self.view_render_b.render_type == 'png':
+                log.logger.debug(f'comparing pngs {path_a} to {path_b}')
+                if args.compare_engine == 'numpy':
+                    self.compare_images_numpy(path_a, path_b, self.compare_metric,
+                                              self.view_render_a.content, self.view_render_b.content)
                 else:
-                    raise RuntimeError(
-                        f'Invalid render_type pairs, A: {self.view_render_a.render_type}, B: {self.view_render_b.render_type}')
-                self.succeeded = True
+                    self.compare_images(path_a, path_b, self.compare_metric,
+                                        self.view_render_a.content, self.view_render_b.content)
+            elif self.view_render_a.render_type == 'csv' and self.view_render_b.render_type == 'csv':
+                log.logger.debug(f'comparing csvs {path_a} to {path_b}')
+                if args.csv_engine == 'hash':
+                    self.compare_csvs_hash(path_a, path_b, self.view_render_a.content, self.view_render_b.content)
+                else:
+                    self.compare_csvs(path_a, path_b, self.view_render_a.content, self.view_render_b.content)
+            else:
+                raise RuntimeError(
+                    f'Invalid render_type pairs, A: {self.view_render_a.render_type}, B: {self.view_render_b.render_type}')
+            self.succeeded = True
+
+    def triagePerceptualHashes(self, path_a, path_b, byte_identical=False):
+        # byte-identical renders hash the same, decode only one. Both still go to phash_index.csv
+        self.phash_a = perceptualHash(path_a, self.view_render_a.content)
+        self.phash_b = self.phash_a if byte_identical else perceptualHash(path_b, self.view_render_b.content)
+        self.phash_distance = bin(self.phash_a ^ self.phash_b).count('1')
+        if self.phash_distance == 0:
+            self.triage = 'identical'
+        elif self.phash_distance <= args.phash_threshold:
+            self.triage = 'cosmetic'
+        else:
+            self.triage = 'structural'
+
+    def recordError(self, e):
+        errortext = f"Error encountered processing {self.view_render_a.site_view.view.id} and/or {self.view_render_b.site_view.view.id} into {self.view_render_a.render_type} / {self.view_render_b.render_type}: {e}, {sys.exc_info()}"
+        self.error_text = errortext
+        log.logger.error(errortext)
+
+    def keepRenders(self, reused=()):
+        # in-memory renders only go to disk when they are worth looking at, or when asked to keep everything.
+        # renders the next attempt reuses keep their content until that attempt has compared them
+        for view_render in [self.view_render_a, self.view_render_b]:
+            if view_render.content is not None:
+                if args.keep_renders or self.difference_value or self.error_text or not self.succeeded:
+                    view_render.persist()
+                if view_render not in reused:
+                    view_render.content = None
+
+    def storeDiffs(self):
+        # move the diff files this attempt wrote into the artifact store. Tiled compares write a crop per region
+        # instead of diff_filepath itself, diff_filepath then lists their objects in the order of diff_regions
+        try:
+            if os.path.isfile(self.diff_filepath):
+                self.diff_filepath = artifact_store.adopt(self.diff_filepath)
+            elif self.diff_regions:
+                diff_filepath_base, extension = os.path.splitext(self.diff_filepath)
+                object_paths = []
+                for index in range(len(self.diff_regions.split(';'))):
+                    region_filepath = f'{diff_filepath_base}_{index}{extension}'
+                    if os.path.isfile(region_filepath):
+                        object_paths.append(artifact_store.adopt(region_filepath))
+                if object_paths:
+                    self.diff_filepath = ';'.join(object_paths)
         except Exception as e:
-            errortext = f"Error encountered processing {self.view_render_a.site_view.view.id} and/or {self.view_render_b.site_view.view.id} into {self.view_render_a.render_type} / {self.view_render_b.render_type}: {e}, {sys.exc_info()}"
-            self.error_text = errortext
-            log.logger.error(errortext)
+            log.logger.error(f'Unable to store the diffs of {self.diff_filepath}: {e}, {sys.exc_info()}')
+
+    def finish(self):
+        try:
+            self.timings['task'] = time.perf_counter() - self.perf_start_time
+            if artifact_store is not None:
+                self.storeDiffs()
+            timing_stats.record(self)
+            retrying, reuse_a, reuse_b, delay = retry_policy.decide(self)
+            self.keepRenders([view_render for view_render, reuse in
+                              [(self.view_render_a, reuse_a), (self.view_render_b, reuse_b)] if reuse])
+
+            if retrying:
+                new_attempt_num = self.attempt_num + 1
+                log.logger.debug(f'Enqueuing this comparison for retry number {new_attempt_num} in {delay:.1f}s')
+                retry_policy.schedule(delay, enqueueCompareViewTask, self.view_render_a.site_view,
+                                      self.view_render_b.site_view, self.view_render_a.render_type, self.compare_metric,
+                                      attempt_num=new_attempt_num,
+                                      view_render_a=self.view_render_a if reuse_a else None,
+                                      view_render_b=self.view_render_b if reuse_b else None, shard=self.shard)
+            manifest_entry = run_manifest.createEntry(self, final=not retrying)
+            if task_store is not None:
+                task_store.complete(self, final=not retrying)
+                run_manifest.append(manifest_entry)
+            else:
+                # the manifest only gets the attempt once its report row is on disk, so --resume and --incremental
+                # can't skip a pair whose row was lost
+                self.output_result(on_written=lambda: run_manifest.append(manifest_entry))
+            if phash_index is not None:
+                phash_index.record(self, final=not retrying)
+            if self.fast_path is not None:
+                compare_stats.record(self.view_render_a.render_type, self.fast_path)
+            if self.shard is not None and not retrying:
+                shard_worker.done(self.shard)
+        finally:
+            work_tracker.done()  # a retry was counted when it was scheduled
+
+    def detach(self):
+        # a copy of this task that can be pickled to a --compare-workers process, see runCompare
+        return CompareTask(RenderSnapshot(self.view_render_a), RenderSnapshot(self.view_render_b), self.diff_filepath,
+                           self.compare_metric, self.attempt_num)
+
+    def applyResult(self, compared_task):
+        self.difference_value = compared_task.difference_value
+        self.error_text = compared_task.error_text
+        self.succeeded = compared_task.succeeded
+        self.fast_path = compared_task.fast_path
+        self.timings.update(compared_task.timings)
+        self.diff_regions = compared_task.diff_regions
+        self.early_exit = compared_task.early_exit
+        self.csv_rows_a = compared_task.csv_rows_a
+        self.csv_rows_b = compared_task.csv_rows_b
+        self.csv_differing_rows = compared_task.csv_differing_rows
+        self.phash_a = compared_task.phash_a
+        self.phash_b = compared_task.phash_b
+        self.phash_distance = compared_task.phash_distance
+        self.triage = compared_task.triage
+
+    def execute(self):
+        self.perf_start_time = time.perf_counter()
+        handed_off = False
+        try:
+            self.renderViews()
+            # the compare stage finishes the task once it has compared the renders
+            handed_off = compare_stage is not None and compare_stage.submit(self)
+            if not handed_off:
+                self.compareRenders()
+        except Exception as e:
+            self.recordError(e)
             raise e
         finally:
-            # retry comparison if it failed, and we're still under the retry limit
-            if (not self.succeeded or self.difference_value > 0) and self.attempt_num < args.nr:
-                new_attempt_num = self.attempt_num + 1
-                log.logger.debug(f'Enqueuing this comparison for retry number {new_attempt_num}')
-                enqueueCompareViewTask(self.view_render_a.site_view, self.view_render_b.site_view,
-                                       self.view_render_a.render_type,
-                                       self.compare_metric, attempt_num=new_attempt_num)
-            self.output_result()
+            if not handed_off:
+                self.finish()
+
+
+class RenderSnapshot(object):
+    # the picklable parts of a finished ViewRenderer that comparing it needs
+    def __init__(self, view_render):
+        self.render_type = view_render.render_type
+        self.succeeded = view_render.succeeded
+        self.filepath = view_render.filepath
+        self.output_filepath = view_render.getOutputFilePath()
+        self.content = view_render.content
+        self.content_hash = view_render.content_hash
+
+    def getOutputFilePath(self):
+        return self.output_filepath
+
+
+class CompareStage(object):
+    # compares rendered pairs on a separate pool of processes, so CPU-heavy ImageMagick/pandas work doesn't contend
+    # for the GIL with the render threads. Results come back on the pool's single result thread, which finishes
+    # each task (retries and report row) in turn
+    def __init__(self, workers):
+        self.executor = ProcessPoolExecutor(workers, initializer=initCompareWorker, initargs=(args,))
+        # render threads wait for a slot, so rendered pairs (and their renders in memory) can't pile up faster than
+        # the pool compares them
+        self._slots = threading.BoundedSemaphore(2 * workers)
+
+    def submit(self, compare_task):
+        if not (compare_task.view_render_a.succeeded and compare_task.view_render_b.succeeded):
+            return False  # nothing to compare
+
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(runCompare, compare_task.detach())
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda completed: self.complete(compare_task, completed))
+        return True
+
+    def complete(self, compare_task, future):
+        try:
+            try:
+                compare_task.applyResult(future.result())
+            except Exception as e:
+                compare_task.recordError(e)
+            compare_task.finish()
+        except Exception as e:
+            log.logger.error(f'{e}, {sys.exc_info()}')
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def initCompareWorker(worker_args):
+    # runs once in each --compare-workers process
+    global args
+    args = worker_args
+    log.logger = logging.getLogger()
+    log.logger.setLevel(args.ll)
+
+
+def runCompare(compare_task):
+    # compare a detached CompareTask's renders in a --compare-workers process and send it back with the result
+    compare_task.compareRenders()
+    return compare_task
+
+
+class WorkTracker(object):
+    # counts the view pairs that are queued, rendering, comparing or waiting out a retry backoff, so the run ends as
+    # soon as the last of them finishes
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.outstanding = 0
+        self.closed = False  # set once discovery is over and can't add any more pairs
+
+    def add(self):
+        with self._condition:
+            self.outstanding += 1
+
+    def done(self):
+        with self._condition:
+            self.outstanding -= 1
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def wait(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.closed and self.outstanding == 0)
+
+
+# SQLite column types of the report columns, see REPORT_COLUMN_TYPES
+TASK_STORE_COLUMN_TYPES = {'string': 'TEXT', 'bool': 'INTEGER', 'int64': 'INTEGER', 'float64': 'REAL'}
+
+
+class TaskStore(object):
+    # --task-store sqlite: every compare task and its result in a SQLite database in WAL mode, so progress and
+    # differences can be queried while the run goes, and --resume can pick up the tasks an interrupted run left. It
+    # stands in for task_queue: workers claim tasks in a transaction, and each task's row goes from 'pending' to
+    # 'in_flight' to 'done'. The report is exported from the results table at the end
+    def __init__(self, filepath, columns):
+        self.filepath = filepath
+        self.columns = columns
+        self._available = threading.Condition()
+        self.tasks = {}  # task id -> CompareTask for the pending tasks of this process
+        self.pending = []  # heap of (priority, task id) of self.tasks, the smallest is claimed next
+        self.stop_count = 0  # None tasks from stopWorkers, handed out once no task is left
+        self.known = set()  # (view a id, view b id, render type) the interrupted run had already enqueued
+        self.connection = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')  # WAL stays consistent, only the last commits can be lost
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, view_a TEXT, view_b TEXT, '
+                                'render_type TEXT, compare_metric TEXT, attempt INTEGER, status TEXT, final INTEGER, '
+                                'difference_value REAL, verdict TEXT, site_view_a TEXT, site_view_b TEXT, '
+                                'enqueued_at TEXT, claimed_at TEXT, finished_at TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tasks_pair ON tasks (view_a, view_b, render_type)')
+        column_definitions = ', '.join(f'"{column}" {TASK_STORE_COLUMN_TYPES[REPORT_COLUMN_TYPES.get(column, "string")]}'
+                                       for column in columns)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS results (task_id INTEGER, {column_definitions})')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._lock = threading.Lock()  # one connection, one statement at a time
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def put(self, compare_task):
+        with self._available:
+            if compare_task is None:
+                self.stop_count += 1
+            else:
+                view_render_a, view_render_b = compare_task.view_render_a, compare_task.view_render_b
+                with self.transaction() as connection:
+                    compare_task.task_id = connection.execute(
+                        'INSERT INTO tasks (view_a, view_b, render_type, compare_metric, attempt, status, site_view_a, '
+                        'site_view_b, enqueued_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (view_render_a.site_view.view.id, view_render_b.site_view.view.id, view_render_a.render_type,
+                         compare_task.compare_metric, compare_task.attempt_num, 'pending',
+                         json.dumps(serializeSiteView(view_render_a.site_view)),
+                         json.dumps(serializeSiteView(view_render_b.site_view)),
+                         time.strftime('%Y-%m-%d %H:%M:%S'))).lastrowid
+                self.tasks[compare_task.task_id] = compare_task
+                # with --schedule cost or --priority-list, in the TaskScheduler's order, otherwise oldest first
+                priority = scheduler.getPriority(compare_task) if scheduler is not None else ()
+                heapq.heappush(self.pending, (priority, compare_task.task_id))
+            self._available.notify()
+
+    def get(self):
+        # claim the oldest pending task, or the first in the TaskScheduler's order, blocking until there is one
+        with self._available:
+            while True:
+                self._available.wait_for(lambda: self.tasks or self.stop_count)
+                if not self.tasks:
+                    self.stop_count -= 1
+                    return None
+                priority, task_id = heapq.heappop(self.pending)
+                compare_task = self.tasks.pop(task_id)
+                # the database has the last word on whether the task is still there to claim
+                with self.transaction() as connection:
+                    claimed = connection.execute("UPDATE tasks SET status = 'in_flight', claimed_at = ? "
+                                                 "WHERE id = ? AND status = 'pending'",
+                                                 (time.strftime('%Y-%m-%d %H:%M:%S'), task_id)).rowcount
+                if claimed:
+                    return compare_task
+                log.logger.warning(f'Task {task_id} is no longer pending in {self.filepath}, skipping it')
+                work_tracker.done()
+
+    def qsize(self):
+        with self._available:
+            return len(self.tasks)
+
+    def complete(self, compare_task, final):
+        # store the result of an attempt and mark its task done, in one transaction
+        row = compare_task.getResultRow()
+        with self.transaction() as connection:
+            connection.execute(f'INSERT INTO results VALUES ({", ".join(["?"] * (len(row) + 1))})',
+                               [compare_task.task_id] + row)
+            connection.execute("UPDATE tasks SET status = 'done', final = ?, difference_value = ?, verdict = ?, "
+                               "finished_at = ? WHERE id = ?",
+                               (final, compare_task.difference_value, compare_task.verdict,
+                                time.strftime('%Y-%m-%d %H:%M:%S'), compare_task.task_id))
+
+    def setMeta(self, key, value):
+        with self.transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def getMeta(self, key):
+        with self._lock:
+            row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def isKnown(self, site_view_a, site_view_b, render_type):
+        return (site_view_a.view.id, site_view_b.view.id, render_type) in self.known
+
+    def restore(self):
+        # --resume: requeue the tasks the interrupted run left pending or in flight, and the next attempt of pairs whose
+        # last attempt was done but not final (their retry was still waiting out its backoff)
+        with self.transaction() as connection:
+            rows = connection.execute(
+                'SELECT view_a, view_b, render_type, compare_metric, attempt, status, final, site_view_a, site_view_b '
+                'FROM tasks WHERE id IN (SELECT max(id) FROM tasks GROUP BY view_a, view_b, render_type)').fetchall()
+            connection.execute("UPDATE tasks SET status = 'abandoned' WHERE status IN ('pending', 'in_flight')")
+
+        servers = {}
+        requeued = 0
+        for view_a, view_b, render_type, compare_metric, attempt, status, final, site_view_a, site_view_b in rows:
+            self.known.add((view_a, view_b, render_type))
+            if status == 'done' and final:
+                continue
+            if status == 'done':
+                attempt += 1
+            enqueueCompareViewTask(deserializeSiteView(json.loads(site_view_a), servers),
+                                   deserializeSiteView(json.loads(site_view_b), servers), render_type, compare_metric,
+                                   attempt_num=attempt)
+            requeued += 1
+        log.logger.info(f'Requeued {requeued} unfinished tasks of {len(rows)} view pairs from {self.filepath}')
+
+    def close(self):
+        # export the report from every result in the database, including those of the runs this one resumed
+        if os.path.isfile(report_path):
+            os.remove(report_path)
+        writer = ReportWriter(report_path, self.columns, args.report_format, args.report_interval)
+        writer.start()
+        bool_columns = [index for index, column in enumerate(self.columns) if REPORT_COLUMN_TYPES.get(column) == 'bool']
+        with self._lock:
+            quoted_columns = ', '.join(f'"{column}"' for column in self.columns)
+            for row in self.connection.execute(f'SELECT {quoted_columns} FROM results ORDER BY rowid'):
+                row = list(row)
+                for index in bool_columns:
+                    if row[index] is not None:
+                        row[index] = bool(row[index])
+                writer.write(row)
+        writer.close()
+        self.connection.close()
+        log.logger.info(f'Exported the report from {self.filepath} to {report_path}')
+
+
+class BaselineCache(object):
+    # --baseline-cache: the latest server B render of each view, kept across runs with the updated_at of the view at
+    # the time, so runs against successive builds of server A don't render the unchanged baseline again. Each render
+    # is <server>/<site>/<view luid>.<png|csv> in the cache folder, next to a .json file that describes it
+    def __init__(self, cache_dir, max_age_hours=None):
+        self.cache_dir = cache_dir
+        self.max_age_seconds = max_age_hours * 3600 if max_age_hours else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    def getPath(self, view_render):
+        site_view = view_render.site_view
+        return os.path.join(self.cache_dir, site_view.getCleanServerName(), site_view.getSiteContentUrlString(),
+                            f'{site_view.view.id}.{view_render.render_type}')
+
+    def load(self, view_render):
+        # return (content, when it was rendered) if the cache holds a valid render of the view, otherwise None
+        content_path = self.getPath(view_render)
+        content = None
+        try:
+            with open(f'{content_path}.json', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry['updated_at'] == view_render.site_view.view.updated_at.isoformat() and \
+                    (self.max_age_seconds is None or time.time() - entry['rendered_at'] <= self.max_age_seconds):
+                with open(content_path, 'rb') as f:
+                    content = f.read()
+                if hashlib.sha256(content).hexdigest() != entry['sha256']:
+                    content = None  # another process replaced the render after we read its description
+        except (OSError, ValueError, KeyError):
+            pass  # not cached yet
+
+        with self._lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if content is None:
+            return None
+        return content, datetime.fromtimestamp(entry['rendered_at']).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    def store(self, view_render, content):
+        # keep a new render of the view, replacing the one before
+        content_path = self.getPath(view_render)
+        try:
+            makePath(os.path.dirname(content_path))
+            entry = {'updated_at': view_render.site_view.view.updated_at.isoformat(),
+                     'rendered_at': time.time(),
+                     'sha256': hashlib.sha256(content).hexdigest(),
+                     'view_content_url': view_render.site_view.view.content_url}
+            # write both files whole, other threads and processes may be storing the same view
+            for filepath, data in [(content_path, content), (f'{content_path}.json', json.dumps(entry).encode())]:
+                temporary_path = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(temporary_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temporary_path, filepath)
+            with self._lock:
+                self.stored += 1
+        except Exception as e:
+            log.logger.error(f'Unable to cache the render of {view_render.site_view.view.id} in {content_path}: {e}, '
+                             f'{sys.exc_info()}')
+
+    def logSummary(self):
+        log.logger.info(f'Baseline cache: {self.hits} server B renders reused, {self.misses} not cached or no longer '
+                        f'valid, {self.stored} rendered and cached in {self.cache_dir}')
+
+
+# expected seconds of a compare task by render type, when no earlier report has anything to go by
+DEFAULT_TASK_SECONDS = {'png': 20, 'csv': 10}
+
+
+def readReportRows(filepath):
+    # the rows of a report written by ReportWriter, in any --report-format, as dicts
+    extension = os.path.splitext(filepath)[1]
+    if extension == '.parquet':
+        import pyarrow.parquet as pq
+
+        yield from pq.read_table(filepath).to_pylist()
+    elif extension == '.ndjson':
+        with open(filepath, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # interrupted mid-write
+    else:
+        with open(filepath, newline='', encoding='utf-8') as f:
+            yield from csv.DictReader(f)
+
+
+def toSeconds(value):
+    # a duration or size column of a report row, None when it is empty
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(number) else number
+
+
+class TaskScheduler(object):
+    # --schedule cost and --priority-list: the order in which queued compare tasks are handed to the workers. Pairs on
+    # the priority list go first, in its order. Otherwise, with --schedule cost, the pair expected to take longest goes
+    # first, so a few slow dashboards don't start last and hold up the end of the run. The expected seconds of a pair
+    # come from earlier reports (slower render plus compare), falling back to the views with the same content URL,
+    # then the workbook, then the render type. Compare seconds missing from old reports are estimated from the
+    # render file sizes
+    def __init__(self, history_paths, priority_list_path=None, by_cost=True):
+        self.by_cost = by_cost
+        self.priorities = self.readPriorityList(priority_list_path) if priority_list_path else {}
+        self.costs = {}  # key -> [seconds, ...], keys as in getCostKeys
+        rows = []
+        for filepath in history_paths:
+            try:
+                rows.extend(readReportRows(filepath))
+            except Exception as e:
+                log.logger.warning(f'Unable to read the earlier report {filepath}, skipping it: {e}')
+
+        samples = []
+        for row in rows:
+            render_type = os.path.splitext(row.get('diff_filepath') or '')[1][1:]
+            durations = [toSeconds(row.get(f'view_render_{side}_duration')) for side in 'ab']
+            filesizes = [toSeconds(row.get(f'view_render_{side}_filesize')) for side in 'ab']
+            if render_type not in DEFAULT_TASK_SECONDS or None in durations:
+                continue
+            # both sides render at the same time, the slower one counts
+            samples.append((row, render_type, max(durations), toSeconds(row.get('compare_seconds')),
+                            max(filesize or 0 for filesize in filesizes)))
+
+        timed = [(sample[3], sample[4]) for sample in samples if sample[3] is not None]
+        compare_bytes = sum(filesize for compare_seconds, filesize in timed)
+        compare_seconds_per_byte = sum(compare_seconds for compare_seconds, filesize in timed) / compare_bytes \
+            if compare_bytes else 0
+        for row, render_type, render_seconds, compare_seconds, filesize in samples:
+            if compare_seconds is None:
+                compare_seconds = filesize * compare_seconds_per_byte
+            for key in self.getCostKeys(row['server_a_view_luid'], row['server_b_view_luid'],
+                                        row['server_a_view_content_url'], render_type):
+                self.costs.setdefault(key, []).append(render_seconds + compare_seconds)
+        self.costs = {key: sum(seconds) / len(seconds) for key, seconds in self.costs.items()}
+        if by_cost:
+            log.logger.info(f'Scheduling by expected cost from {len(samples)} results in {len(history_paths)} earlier '
+                            f'reports')
+
+    def readPriorityList(self, filepath):
+        # workbook or view content URLs, or view LUIDs, from the first column of the --priority-list csv -> rank
+        priorities = {}
+        with open(filepath, newline='') as priority_list_file:
+            for line in csv.reader(priority_list_file):
+                if line and line[0].strip():
+                    priorities.setdefault(line[0].strip(), len(priorities))
+        return priorities
+
+    def getCostKeys(self, view_a_id, view_b_id, view_a_content_url, render_type):
+        # from the most to the least specific estimate of a pair's cost
+        return [('pair', view_a_id, view_b_id, render_type),
+                ('view', view_a_content_url, render_type),
+                ('workbook', view_a_content_url.split('/')[0], render_type),
+                ('render_type', render_type)]
+
+    def getExpectedSeconds(self, compare_task):
+        site_view_a = compare_task.view_render_a.site_view
+        render_type = compare_task.view_render_a.render_type
+        for key in self.getCostKeys(site_view_a.view.id, compare_task.view_render_b.site_view.view.id,
+                                    site_view_a.view.content_url, render_type):
+            if key in self.costs:
+                return self.costs[key]
+        return DEFAULT_TASK_SECONDS.get(render_type, 0)
+
+    def getPriority(self, compare_task):
+        # sort key of a task, the smallest goes first
+        rank = len(self.priorities)
+        for site_view in [compare_task.view_render_a.site_view, compare_task.view_render_b.site_view]:
+            for name in [site_view.view.id, site_view.view.content_url, site_view.workbook_content_url]:
+                rank = min(rank, self.priorities.get(name, rank))
+        return rank, -self.getExpectedSeconds(compare_task) if self.by_cost else 0
+
+
+class ScheduledQueue(PriorityQueue):
+    # stands in for task_queue with a TaskScheduler: tasks come out in its order, and in the order they were put in
+    # when it ranks them the same. The None tasks from stopWorkers come out after every task
+    def __init__(self, scheduler):
+        PriorityQueue.__init__(self)
+        self.scheduler = scheduler
+        self.sequence = itertools.count()
+
+    def put(self, compare_task, block=True, timeout=None):
+        priority = (math.inf,) if compare_task is None else self.scheduler.getPriority(compare_task)
+        PriorityQueue.put(self, (priority, next(self.sequence), compare_task), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        return PriorityQueue.get(self, block, timeout)[-1]
+
+
+def stopWorkersWhenDone(worker_count):
+    # once every pair has finished, let the workers go
+    work_tracker.wait()
+    stopWorkers(worker_count)
+
+
+def stopWorkers(worker_count):
+    # wake each idle worker with a None task so it exits
+    for index in range(worker_count):
+        task_queue.put(None)
 
 
 class TaskWorker(Thread):
@@ -627,12 +1799,14 @@ class TaskWorker(Thread):
         self.threadname = threadname
 
     def run(self):
-        # loop infinitely, breaking when the queue is out of work (should add a timeout!)
+        # loop infinitely, breaking on the None task stopWorkers sends once there is no more work
         log.logger.info(f'Taskworker with thread {self.threadname} has started')
         log.logger.info(f'Taskworker says queue has {self.queue.qsize()} tasks')
-        while not self.queue.empty():
+        while True:
             # Get the task from the queue and run it
             task = self.queue.get()
+            if task is None:
+                break
             log.logger.debug(f'Taskworker got task {task}')
 
             # process the task
@@ -645,126 +1819,1673 @@ class TaskWorker(Thread):
                 continue
 
 
-class ThreadSafeCSVWriter(object):
-    def __init__(self, *args, **kwargs):
-        self._writer = csv.writer(*args, **kwargs)
-        self._lock = threading.Lock()
+class AsyncRenderEngine(object):
+    # renders compare tasks on one asyncio event loop over a shared aiohttp client, talking to the REST
+    # image/data endpoints directly, in place of the TaskWorker threads and the shared render pool
+    def __init__(self, server_concurrency):
+        self.server_concurrency = server_concurrency  # compare tasks in flight per server
+        self.client = None
+        self._limits = {}
+        self._adaptive_slots = None
+        self._sessions = {}
+        self._sign_in_locks = {}
+
+    def run(self, queue):
+        asyncio.run(self.drain(queue))
+
+    async def drain(self, queue):
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        self._adaptive_slots = asyncio.Condition()
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False, limit=0)) as self.client:
+            in_flight = set()
+            while True:
+                # pick up new work as it arrives, including retries enqueued by the tasks that just finished,
+                # until the None task stopWorkersWhenDone sends once there is no more
+                try:
+                    compare_task = await loop.run_in_executor(None, queue.get)
+                except asyncio.CancelledError:
+                    # Ctrl-C: wake the get still waiting in the executor, which asyncio.run waits for on its way out
+                    queue.put(None)
+                    raise
+                if compare_task is None:
+                    break
+                future = asyncio.ensure_future(self.execute(compare_task))
+                in_flight.add(future)
+                future.add_done_callback(self.taskDone(in_flight))
+            await asyncio.gather(*in_flight)
+            await self.signOutAll()
+
+    async def releaseAdaptive(self, view_renders):
+        for view_render in view_renders:
+            adaptive_concurrency.release(view_render)
+        async with self._adaptive_slots:
+            self._adaptive_slots.notify_all()
+
+    @staticmethod
+    def taskDone(in_flight):
+        def done(future):
+            in_flight.discard(future)
+            if future.exception():
+                log.logger.error(f'{future.exception()}')
+        return done
+
+    async def execute(self, compare_task):
+        compare_task.perf_start_time = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            await self.renderViews(compare_task)
+            if compare_stage is not None and \
+                    compare_task.view_render_a.succeeded and compare_task.view_render_b.succeeded:
+                compare_task.applyResult(
+                    await loop.run_in_executor(compare_stage.executor, runCompare, compare_task.detach()))
+            else:
+                await loop.run_in_executor(None, compare_task.compareRenders)
+        except Exception as e:
+            compare_task.recordError(e)
+        finally:
+            # finish writes the task's state and report row, which may wait on the report writer: off the loop
+            await loop.run_in_executor(None, compare_task.finish)
+
+    async def renderViews(self, compare_task):
+        # a retry may reuse the render of the side that succeeded last time, or server B's may come from the cache
+        await asyncio.get_running_loop().run_in_executor(None, compare_task.loadCachedBaseline)
+        view_renders = [view_render for view_render in [compare_task.view_render_a, compare_task.view_render_b]
+                        if not view_render.is_complete]
+
+        async with contextlib.AsyncExitStack() as stack:
+            if adaptive_concurrency is not None:
+                # a slot on both servers at once, see AdaptiveConcurrency
+                server_addresses = [view_render.site_view.server.server_address for view_render in view_renders]
+                async with self._adaptive_slots:
+                    await self._adaptive_slots.wait_for(lambda: adaptive_concurrency.tryAcquire(server_addresses))
+                stack.push_async_callback(self.releaseAdaptive, view_renders)
+            else:
+                # take a slot on each server in a fixed order so pairs can never deadlock each other
+                for server_address in sorted({view_render.site_view.server.server_address
+                                              for view_render in view_renders}):
+                    if server_address not in self._limits:
+                        self._limits[server_address] = asyncio.Semaphore(self.server_concurrency)
+                    await stack.enter_async_context(self._limits[server_address])
+
+            # sign in first so both requests leave at the same time
+            signin_start = time.perf_counter()
+            sessions = await asyncio.gather(*[self.getSession(view_render.site_view) for view_render in view_renders],
+                                            return_exceptions=True)
+            for view_render in view_renders:
+                view_render.timings['signin'] = time.perf_counter() - signin_start
+            await asyncio.gather(*[self.render(view_render, session)
+                                   for view_render, session in zip(view_renders, sessions)])
+
+    async def render(self, view_render, session):
+        view_render.perf_start_time = time.perf_counter()
+        try:
+            if isinstance(session, Exception):
+                raise session
+            if view_render.render_type == 'png':
+                endpoint, params = 'image', {'resolution': 'high', 'maxAge': '0'}
+            elif view_render.render_type == 'csv':
+                endpoint, params = 'data', {'maxAge': '0'}
+            else:
+                raise RuntimeError(f'Invalid render_type provided, {view_render.render_type}')
 
-    def writerow(self, row):
-        with self._lock:
-            return self._writer.writerow(row)
+            with timePhase(view_render.timings, 'request'):
+                content = await self.download(view_render, session,
+                                              f'views/{view_render.site_view.view.id}/{endpoint}', params)
+            with timePhase(view_render.timings, 'write'):
+                await asyncio.get_running_loop().run_in_executor(None, view_render.save, content)
+        except Exception as e:
+            view_render.error_text = f'Error rendering to {view_render.render_type}: {e}, {sys.exc_info()}'
+        finally:
+            view_render.complete()
+
+    async def download(self, view_render, session, path, params):
+        site_view = view_render.site_view
+        view_render.start_time = time.strftime('%Y-%m-%d %H:%M:%S.') + getCurrentMicrosecondsStr()
+        view_render.perf_start_time = time.perf_counter()
+        for attempt in range(2):
+            token, site_id = session
+            url = f'{site_view.server.server_address}/api/{APIVERSION}/sites/{site_id}/{path}'
+            async with self.client.get(url, params=params, headers={'X-Tableau-Auth': token}) as response:
+                if response.status == 401 and attempt == 0:
+                    # sign in again once if the session has expired
+                    log.logger.info(f'Session on {site_view.server.server_address}, site "{site_view.site.content_url}" expired. Signing in again')
+                    session = await self.getSession(site_view, expired_session=session)
+                    continue
+                if response.status >= 400:
+                    raise RuntimeError(f'HTTP {response.status} from {url}: {await response.text()}')
+                return await response.read()
+
+    def getSessionKey(self, site_view):
+        return site_view.server.server_address, site_view.site.content_url
+
+    async def getSession(self, site_view, expired_session=None):
+        # one signed-in token per (server address, site content_url), shared by every request on the loop
+        key = self.getSessionKey(site_view)
+        if key not in self._sign_in_locks:
+            self._sign_in_locks[key] = asyncio.Lock()
+        async with self._sign_in_locks[key]:
+            if key not in self._sessions or self._sessions[key] is expired_session:
+                self._sessions[key] = await self.signIn(*key)
+            return self._sessions[key]
+
+    async def signIn(self, server_address, site_content_url):
+        url = f'{server_address}/api/{APIVERSION}/auth/signin'
+        body = {'credentials': {'name': args.u, 'password': password, 'site': {'contentUrl': site_content_url}}}
+        async with self.client.post(url, json=body, headers={'Accept': 'application/json'}) as response:
+            if response.status != 200:
+                raise RuntimeError(f'Unable to sign in to {server_address}, site "{site_content_url}": '
+                                   f'HTTP {response.status}, {await response.text()}')
+            credentials = (await response.json())['credentials']
+        log.logger.debug(f'Opened session on {server_address}, site "{site_content_url}"')
+        return credentials['token'], credentials['site']['id']
+
+    async def signOutAll(self):
+        for (server_address, site_content_url), (token, site_id) in self._sessions.items():
+            try:
+                async with self.client.post(f'{server_address}/api/{APIVERSION}/auth/signout',
+                                            headers={'X-Tableau-Auth': token}):
+                    pass
+            except Exception as e:
+                log.logger.debug(f'Unable to sign out of {server_address}: {e}')
+        self._sessions = {}
 
-    def writerows(self, rows):
-        with self._lock:
-            return self._writer.writerows(rows)
 
+class RunManifest(object):
+    # append-only log of every finished compare attempt (view pair, render type, attempt) and its artifacts. It lets
+    # --resume skip the pairs an interrupted run already finished, and --incremental skip pairs that were unchanged
+    # and difference-free last time
+    def __init__(self, filepath, resume=False, incremental=False):
+        self.filepath = filepath
+        self.incremental = incremental
+        self._lock = threading.Lock()
+        self.entries = self.load() if (resume or incremental) else []
 
-def getViews(servername):
-    # return a list of views found on a given server, site, project, and with a particular name
-    views = []
-    return_list = []
-    sites = getSites(servername)
+        if resume and self.entries:
+            self.run_id = self.entries[-1]['run']
+        else:
+            self.run_id = datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+        # the latest entry per pair in this run, and the latest final entry per pair in earlier runs
+        self.current = {}
+        self.previous = {}
+        for entry in self.entries:
+            key = (entry['view_a'], entry['view_b'], entry['render_type'])
+            if entry['run'] == self.run_id:
+                self.current[key] = entry
+            elif entry['final']:
+                self.previous[key] = entry
+
+    def load(self):
+        entries = []
+        if os.path.isfile(self.filepath):
+            with open(self.filepath, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        log.logger.debug(f'Ignoring incomplete manifest line: {line}')  # interrupted mid-write
+        return entries
+
+    def save(self):
+        with self._lock, open(self.filepath, 'w', encoding='utf-8') as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry) + '\n')
+
+    def createEntry(self, compare_task, final):
+        view_render_a = compare_task.view_render_a
+        view_render_b = compare_task.view_render_b
+        entry = {'run': self.run_id,
+                 'view_a': view_render_a.site_view.view.id,
+                 'view_b': view_render_b.site_view.view.id,
+                 'render_type': view_render_a.render_type,
+                 'attempt': compare_task.attempt_num,
+                 'final': final,
+                 'succeeded': compare_task.succeeded,
+                 'difference_value': compare_task.difference_value,
+                 'updated_a': view_render_a.site_view.view.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+                 'updated_b': view_render_b.site_view.view.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+                 'artifacts': {'a': view_render_a.filepath,
+                               'b': view_render_b.filepath,
+                               'diff': compare_task.diff_filepath if compare_task.difference_value else ''}}
+        return entry
+
+    def append(self, entry):
+        with self._lock, open(self.filepath, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+
+    def getStartAttempt(self, site_view_a, site_view_b, render_type):
+        # return the attempt number this pair should start from, or None if there is nothing left to do for it
+        key = (site_view_a.view.id, site_view_b.view.id, render_type)
+        entry = self.current.get(key)
+        if entry:
+            return None if entry['final'] else entry['attempt'] + 1
+
+        previous = self.previous.get(key)
+        if self.incremental and previous and previous['succeeded'] and previous['difference_value'] == 0 and \
+                previous['updated_a'] == site_view_a.view.updated_at.strftime('%Y-%m-%d %H:%M:%S') and \
+                previous['updated_b'] == site_view_b.view.updated_at.strftime('%Y-%m-%d %H:%M:%S'):
+            return None
+        return 0
+
+
+class ArtifactStore(object):
+    # content-addressed storage for renders and diffs with --artifact-store. Each unique file is written once to
+    # objects/<first two hex digits>/<sha256><extension> in --f, however many attempts or views produce it. The
+    # manifest maps the path every file would have had in the usual folder layout to its object, so --role export can
+    # lay the folders out again
+    def __init__(self, work_dir, manifest_path):
+        self.work_dir = work_dir
+        self.manifest_path = manifest_path
+        self._lock = threading.Lock()
+        self.referenced_count = 0
+        self.referenced_bytes = 0
+        self.stored_count = 0
+        self.stored_bytes = 0
+
+    def put(self, content, logical_path):
+        # store content unless an identical object exists, record logical_path as a reference to it and return the
+        # object's path
+        sha256 = hashlib.sha256(content).hexdigest()
+        object_path = os.path.join(self.work_dir, "objects", sha256[:2], sha256 + os.path.splitext(logical_path)[1])
+        stored = False
+        if not os.path.isfile(object_path):
+            makePath(os.path.dirname(object_path))
+            # another thread or worker may write the same object, each writes its own file and the last one wins
+            temporary_path = f'{object_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporary_path, 'wb') as f:
+                f.write(content)
+            os.replace(temporary_path, object_path)
+            stored = True
+
+        entry = {'path': os.path.relpath(logical_path, self.work_dir),
+                 'object': os.path.relpath(object_path, self.work_dir),
+                 'sha256': sha256,
+                 'size': len(content)}
+        with self._lock, open(self.manifest_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+            self.referenced_count += 1
+            self.referenced_bytes += len(content)
+            if stored:
+                self.stored_count += 1
+                self.stored_bytes += len(content)
+        return object_path
+
+    def adopt(self, filepath):
+        # move a file that was written to its place in the folder layout into the store
+        with open(filepath, 'rb') as f:
+            object_path = self.put(f.read(), filepath)
+        os.remove(filepath)
+        return object_path
+
+    def logSummary(self):
+        if self.referenced_count:
+            log.logger.info(f'Artifact store: {self.referenced_count} files ({self.referenced_bytes} bytes) stored as '
+                            f'{self.stored_count} objects ({self.stored_bytes} bytes), '
+                            f'{1 - self.stored_bytes / max(self.referenced_bytes, 1):.1%} saved by deduplication')
+
+
+def exportArtifacts():
+    # --role export: lay out the renders and diffs of an --artifact-store run in the usual folders of --f, hard linked
+    # to their objects where the file system allows it. The latest entry for a path wins
+    results_dir = os.path.join(args.f, "results")
+    manifest_paths = [os.path.join(args.f, "artifacts.jsonl")]
+    for name in sorted(os.listdir(results_dir)) if os.path.isdir(results_dir) else []:
+        if name.endswith('.artifacts.jsonl'):
+            manifest_paths.append(os.path.join(results_dir, name))
+    objects = {}
+    for manifest_path in manifest_paths:
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # interrupted mid-write
+                    objects[entry['path']] = entry['object']
+
+    exported = 0
+    for logical_path, object_path in objects.items():
+        target_path = os.path.join(args.f, logical_path)
+        source_path = os.path.join(args.f, object_path)
+        try:
+            makePath(os.path.dirname(target_path))
+            if os.path.exists(target_path):
+                os.remove(target_path)
+            try:
+                os.link(source_path, target_path)
+            except OSError:
+                shutil.copyfile(source_path, target_path)
+            exported += 1
+        except Exception as e:
+            log.logger.error(f'Unable to export {logical_path}: {e}, {sys.exc_info()}')
+    log.logger.info(f'Exported {exported} of {len(objects)} artifacts to {args.f}')
+
+
+# a --role worker holds at most this many shards at once, so the next one is queued while it finishes the last
+SHARD_PREFETCH = 2
+# seconds between looks at the shared --f for new, expired or finished shards while a worker has nothing to claim
+SHARD_POLL_SECONDS = 2
+
+
+def serializeSiteView(site_view):
+    # what a --role worker needs of a SiteView to render it, see deserializeSiteView
+    view = site_view.view
+    return {'server': site_view.server.server_address,
+            'site': {'id': site_view.site.id, 'name': site_view.site.name, 'content_url': site_view.site.content_url},
+            'view': {'id': view.id, 'name': view.name, 'content_url': view.content_url,
+                     'workbook_id': view.workbook_id, 'updated_at': view.updated_at.isoformat()}}
+
+
+def deserializeSiteView(data, servers):
+    # rebuild a SiteView written by serializeSiteView. Renders get their signed-in session from the session pool, so
+    # the TSC.Server only has to carry the address; servers caches one per address
+    import tableauserverclient as TSC
+
+    if data['server'] not in servers:
+        servers[data['server']] = TSC.Server(data['server'])
+    site = TSC.SiteItem(data['site']['name'], data['site']['content_url'])
+    site._id = data['site']['id']
+    view = TSC.ViewItem()
+    view._id = data['view']['id']
+    view._name = data['view']['name']
+    view._content_url = data['view']['content_url']
+    view._workbook_id = data['view']['workbook_id']
+    view._updated_at = datetime.fromisoformat(data['view']['updated_at'])
+    return SiteView(view, site, servers[data['server']], None)
+
+
+def writeJsonAtomically(filepath, data):
+    # readers on other hosts see the whole file or none of it
+    temporary_filepath = f'{filepath}.{os.getpid()}.tmp'
+    with open(temporary_filepath, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temporary_filepath, filepath)
+
+
+class ShardWriter(object):
+    # --role coordinator: writes the matched view pairs to --f/shards as discovery finds them, shard_size pairs a file,
+    # so workers can start on the first shards while the views are still being listed
+    def __init__(self, shard_dir, shard_size, run_id):
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        self.pairs = []
+        self.shard_count = 0
+        self.pair_count = 0
+        makePath(shard_dir)
+        # before any shard, so workers can tell this run from whatever an earlier one left in --f
+        writeJsonAtomically(os.path.join(shard_dir, 'run'), {'run': run_id})
+        log.logger.info(f'Coordinating run {run_id} in {shard_dir}')
+
+    def add(self, site_view_a, site_view_b):
+        self.pairs.append([serializeSiteView(site_view_a), serializeSiteView(site_view_b)])
+        self.pair_count += 1
+        if len(self.pairs) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if self.pairs:
+            writeJsonAtomically(os.path.join(self.shard_dir, f'{self.shard_count:06d}.json'), {'pairs': self.pairs})
+            self.shard_count += 1
+            self.pairs = []
+
+    def close(self):
+        # the complete file tells the workers how many shards to wait for
+        self.flush()
+        writeJsonAtomically(os.path.join(self.shard_dir, 'complete'),
+                            {'shards': self.shard_count, 'pairs': self.pair_count})
+        log.logger.info(f'Wrote {self.pair_count} view pairs in {self.shard_count} shards to {self.shard_dir}')
+
+
+class ShardWorker(object):
+    # --role worker: claims the coordinator's shards and enqueues their view pairs. A claim is a lease file created with
+    # O_EXCL, so only one worker can make it, and a heartbeat keeps it fresh. A lease that has gone lease_seconds
+    # without a heartbeat belonged to a worker that died or hung, and any worker may take the shard over by creating
+    # the lease of the next generation. Finished shards get a done file naming the worker whose results count
+    def __init__(self, work_dir, worker_id, lease_seconds, run_id=None):
+        self.shard_dir = os.path.join(work_dir, 'shards')
+        self.run_id = run_id  # the coordinator's run this worker works on, see waitForCoordinator
+        self.lease_dir = os.path.join(work_dir, 'leases')
+        self.done_dir = os.path.join(work_dir, 'done')
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self._condition = threading.Condition()
+        self.held = {}  # (shard, generation) -> tasks of the shard's pairs not yet finished
+        self.finished = 0
+
+    def readRunId(self):
+        try:
+            with open(os.path.join(self.shard_dir, 'run'), encoding='utf-8') as f:
+                return json.load(f)['run']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def waitForCoordinator(self):
+        # the coordinator empties --f and writes its run id before the first shard, so nothing may be written there
+        # before that. Without --run-id, a finished run is one an earlier coordinator left behind: wait for the next
+        finished_run = None
+        if self.run_id is None and self.isComplete():
+            finished_run = self.readRunId()
+        while True:
+            run_id = self.readRunId()
+            if run_id is not None and run_id != finished_run and self.run_id in (None, run_id):
+                break
+            log.logger.info(f'Waiting for a coordinator to start {"run " + self.run_id if self.run_id else "a new run"} '
+                            f'in {self.shard_dir}')
+            time.sleep(SHARD_POLL_SECONDS)
+        self.run_id = run_id
+        log.logger.info(f'Working on run {run_id} in {self.shard_dir}')
+        makePath(self.lease_dir)
+        makePath(self.done_dir)
 
-    for site in sites:
-        if args.si:
-            # if filtered to a site, skip all but the one we want
-            if site.name != args.si:
+    def run(self):
+        try:
+            next_heartbeat = 0
+            while True:
+                if time.monotonic() >= next_heartbeat:
+                    self.heartbeat()
+                    next_heartbeat = time.monotonic() + self.lease_seconds / 3
+
+                with self._condition:
+                    full = len(self.held) >= SHARD_PREFETCH
+                claimed = None if full else self.claim()
+                if claimed is not None:
+                    self.enqueueShard(*claimed)
+                    continue
+                if self.isComplete():
+                    break
+                if self.readRunId() != self.run_id:
+                    log.logger.error(f'A coordinator started another run in {self.shard_dir}, stopping run {self.run_id}')
+                    break
+
+                # wake up when one of our shards finishes, to look for more work or the next heartbeat
+                with self._condition:
+                    self._condition.wait(max(0, min(SHARD_POLL_SECONDS, next_heartbeat - time.monotonic())))
+            log.logger.info(f'All shards are done, {self.finished} of them by worker {self.worker_id}')
+        except Exception as e:
+            log.logger.error(f'Error encountered claiming shards in {self.shard_dir}: {e}, {sys.exc_info()}')
+        finally:
+            work_tracker.close()
+
+    def getLeasePath(self, shard, generation):
+        return os.path.join(self.lease_dir, f'{shard}.{generation}')
+
+    def getLeaseGenerations(self):
+        # the latest lease generation of every shard that has one
+        generations = {}
+        for name in os.listdir(self.lease_dir):
+            shard, _, generation = name.rpartition('.')
+            generations[shard] = max(generations.get(shard, -1), int(generation))
+        return generations
+
+    def claim(self):
+        # lease the first shard that is neither done nor leased, or whose lease has expired. Returns (shard, generation)
+        done = set(os.listdir(self.done_dir))
+        generations = self.getLeaseGenerations()
+        for name in sorted(os.listdir(self.shard_dir)):
+            shard, extension = os.path.splitext(name)
+            if extension != '.json' or shard in done:
                 continue
+            generation = generations.get(shard, -1)
+            if generation >= 0:
+                try:
+                    idle_seconds = time.time() - os.stat(self.getLeasePath(shard, generation)).st_mtime
+                except FileNotFoundError:
+                    continue
+                if idle_seconds < self.lease_seconds:
+                    continue
+            try:
+                fd = os.open(self.getLeasePath(shard, generation + 1), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue  # another worker got there first
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.worker_id)
+            if generation >= 0:
+                log.logger.warning(f'Taking over shard {shard}, its lease had no heartbeat for {idle_seconds:.0f}s')
+            else:
+                log.logger.info(f'Claimed shard {shard}')
+            return shard, generation + 1
+        return None
+
+    def enqueueShard(self, shard, generation):
+        with open(os.path.join(self.shard_dir, f'{shard}.json'), encoding='utf-8') as f:
+            pairs = json.load(f)['pairs']
+        key = (shard, generation)
+        with self._condition:
+            self.held[key] = 1  # keeps the shard open until all of its pairs are enqueued
+        servers = {}
+        for data_a, data_b in pairs:
+            enqueueCompareViewPair(deserializeSiteView(data_a, servers), deserializeSiteView(data_b, servers), key)
+        self.done(key)
+
+    def add(self, key):
+        with self._condition:
+            if key in self.held:
+                self.held[key] += 1
+
+    def done(self, key):
+        # a pair of the shard had its last attempt
+        with self._condition:
+            if key not in self.held:
+                return  # the lease was lost, the shard belongs to another worker now
+            self.held[key] -= 1
+            if self.held[key]:
+                return
+            del self.held[key]
+        self.markDone(*key)
+        with self._condition:
+            self._condition.notify_all()
+
+    def markDone(self, shard, generation):
+        if self.getLeaseGenerations().get(shard) != generation:
+            log.logger.warning(f'Finished shard {shard} after another worker took it over, its results will be ignored')
+            return
+        # the shard's rows must be on disk before the merge can count on them
+        report_writer.sync()
+        try:
+            fd = os.open(os.path.join(self.done_dir, shard), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': self.worker_id, 'generation': generation}, f)
+        self.finished += 1
+        log.logger.info(f'Finished shard {shard}')
+
+    def heartbeat(self):
+        # renew the leases this worker holds, letting go of any that another worker has taken over
+        with self._condition:
+            held = list(self.held)
+        generations = self.getLeaseGenerations()
+        for shard, generation in held:
+            if generations.get(shard) != generation:
+                log.logger.warning(f'Lost the lease on shard {shard} to another worker, its results will be ignored')
+                with self._condition:
+                    self.held.pop((shard, generation), None)
+                    self._condition.notify_all()
+                continue
+            os.utime(self.getLeasePath(shard, generation))
+
+    def isComplete(self):
+        complete_path = os.path.join(self.shard_dir, 'complete')
+        if not os.path.isfile(complete_path):
+            return False  # the coordinator is still writing shards
+        with open(complete_path, encoding='utf-8') as f:
+            shard_count = json.load(f)['shards']
+        return os.path.isdir(self.done_dir) and len(os.listdir(self.done_dir)) >= shard_count
+
+
+def mergeShardResults(columns):
+    # --role merge: write the report from the workers' results. A shard's pairs only count the rows of the worker that
+    # finished it, so a worker that lost its lease can't add duplicates
+    shard_dir = os.path.join(args.f, 'shards')
+    done_dir = os.path.join(args.f, 'done')
+    results_dir = os.path.join(args.f, 'results')
+
+    owners = {}  # (view a id, view b id) -> worker that finished the pair's shard
+    unfinished = []
+    for name in sorted(os.listdir(shard_dir)):
+        shard, extension = os.path.splitext(name)
+        if extension != '.json':
+            continue
+        with open(os.path.join(shard_dir, name), encoding='utf-8') as f:
+            pairs = json.load(f)['pairs']
+        done_path = os.path.join(done_dir, shard)
+        if os.path.isfile(done_path):
+            with open(done_path, encoding='utf-8') as f:
+                owner = json.load(f)['worker']
+            for data_a, data_b in pairs:
+                owners[(data_a['view']['id'], data_b['view']['id'])] = owner
+        else:
+            unfinished.append(shard)
+
+    rows = {}  # (view a id, view b id, render type, attempt) -> report row, in the order they were written
+    for name in sorted(os.listdir(results_dir)) if os.path.isdir(results_dir) else []:
+        worker, extension = os.path.splitext(name)
+        if extension != '.ndjson':
+            continue
+        with open(os.path.join(results_dir, name), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue  # the worker was stopped mid-write
+                pair = (row['server_a_view_luid'], row['server_b_view_luid'])
+                if owners.get(pair, worker) != worker:
+                    continue
+                render_type = os.path.splitext(row['diff_filepath'])[1]
+                rows[pair + (render_type, row['attempt_number'])] = [row.get(column) for column in columns]
+
+    if os.path.isfile(report_path):
+        os.remove(report_path)
+    writer = ReportWriter(report_path, columns, args.report_format, args.report_interval)
+    writer.start()
+    for row in rows.values():
+        writer.write(row)
+    writer.close()
+
+    log.logger.info(f'Merged {len(rows)} results of {len(owners)} view pairs into {report_path}')
+    if unfinished:
+        log.logger.warning(f'{len(unfinished)} shards were not finished, their pairs may be missing from the report: '
+                           f'{", ".join(unfinished)}')
+
+
+class SessionPool(object):
+    # hands out signed-in TSC.Server objects keyed by (server address, site content_url), so every render
+    # reuses an authenticated session for the whole run instead of signing in for each request
+    def __init__(self, size):
+        self.size = max(size, 1)  # sessions per key; each worker thread holds at most one per server at a time
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._sessions = []
 
-        tableau_auth = TSC.TableauAuth(args.u, password, site_id=site.content_url)
-        server = TSC.Server(servername)
+    def signIn(self, server_address, site_content_url):
+        import tableauserverclient as TSC
+
+        tableau_auth = TSC.TableauAuth(args.u, password, site_id=site_content_url)
+        server = TSC.Server(server_address)
         server.add_http_options({'verify': False})
         server.version = APIVERSION
+        server.auth.sign_in(tableau_auth)
+        log.logger.debug(f'Opened session on {server_address}, site "{site_content_url}"')
+        return server
 
-        with server.auth.sign_in(tableau_auth):
-            log.logger.info(f"signed in to {servername}, {site.name}, {site.content_url}, {site.state}")
-            req_option = TSC.RequestOptions()
-
-            # get the server information
-            server_info = server.server_info.get()
-
-            # if workbook name passed, filter on it
-            if args.wi:
-                req_option.filter.add(TSC.Filter(TSC.RequestOptions.Field.Name,
-                                                 TSC.RequestOptions.Operator.Equals,
-                                                 args.wi))
-
-            # if filtering by project, add that criteria
-            if args.pi:
-                req_option.filter.add(TSC.Filter(TSC.RequestOptions.Field.ProjectName,
-                                                 TSC.RequestOptions.Operator.Equals,
-                                                 args.pi))
-
-            if args.wi or args.pi:
-                # get the filtered workbooks, then derive the views from them
-                filtered_workbooks = list(TSC.Pager(server.workbooks, req_option))
-                filtered_views = []
-                for workbook in filtered_workbooks:
-                    server.workbooks.populate_views(workbook)
-                    filtered_views.extend(workbook.views)
-                    log.logger.debug(f'Found {len(filtered_views)} views')
-            else:
-                # no filtering, so just grab all the views on the site
-                filtered_views = list(TSC.Pager(server.views))
-
-            # if filtering by file, remove any non-matches
-            if args.vi:
-                log.logger.debug(f'filtering views to those provided in {args.vi}')
-                view_list = []
-                with open(args.vi, newline='') as view_list_file:
-                    view_list_reader = csv.reader(view_list_file)
-                    log.logger.debug('iterating over the views found')
-                    for line in view_list_reader:
-                        view_list.append(line[0])
-
-                file_filtered_views = []
-                for view in filtered_views:
-                    for luid in view_list:
-                        if view.id == luid:
-                            file_filtered_views.append(view)
-                log.logger.debug(f'will run over {len(file_filtered_views)} views')
-                time.sleep(5)
-                filtered_views = file_filtered_views
-
-        log.logger.debug(f'Final count is {len(filtered_views)} views')
-
-        # now package up the return list views with their contextual information
-        for view in filtered_views:
-            return_list.append(SiteView(view, site, server, server_info))
-        # views.append({"site_content_url": site.content_url, "views": filtered_views})
-
-    return return_list
+    def acquire(self, server_address, site_content_url):
+        key = (server_address, site_content_url)
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.size)
+                self._idle[key] = []
+        self._slots[key].acquire()
+
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop()
+
+        try:
+            server = self.signIn(server_address, site_content_url)
+        except Exception:
+            self._slots[key].release()
+            raise
+        with self._lock:
+            self._sessions.append(server)
+        return server
+
+    def release(self, server, server_address, site_content_url):
+        key = (server_address, site_content_url)
+        with self._lock:
+            self._idle[key].append(server)
+        self._slots[key].release()
+
+    def run(self, server_address, site_content_url, request):
+        # call request(server) with a pooled session, signing in again once if the session has expired
+        import tableauserverclient as TSC
+
+        server = self.acquire(server_address, site_content_url)
+        try:
+            try:
+                return request(server)
+            except Exception as e:
+                if not isExpiredSessionError(e):
+                    raise
+                log.logger.info(f'Session on {server_address}, site "{site_content_url}" expired. Signing in again')
+                server.auth.sign_in(TSC.TableauAuth(args.u, password, site_id=site_content_url))
+                return request(server)
+        finally:
+            self.release(server, server_address, site_content_url)
+
+    def signOutAll(self):
+        with self._lock:
+            sessions = self._sessions
+            self._sessions = []
+            self._idle = {key: [] for key in self._idle}
+        for server in sessions:
+            try:
+                server.auth.sign_out()
+            except Exception as e:
+                log.logger.debug(f'Unable to sign out of {server.server_address}: {e}')
+
+
+def isExpiredSessionError(e):
+    # Tableau Server answers requests made with an expired or invalidated token with a 401xxx error code
+    import tableauserverclient as TSC
+
+    if isinstance(e, TSC.NotSignedInError):
+        return True
+    return isinstance(e, TSC.ServerResponseError) and str(e.code).startswith('401')
+
+
+# report columns that aren't strings, so columnar reports keep their types
+REPORT_COLUMN_TYPES = {'server_a_view_render_succeeded': 'bool',
+                       'server_b_view_render_succeeded': 'bool',
+                       'compare_succeeded': 'bool',
+                       'attempt_number': 'int64',
+                       'view_render_a_duration': 'float64',
+                       'view_render_b_duration': 'float64',
+                       'view_render_a_filesize': 'int64',
+                       'view_render_b_filesize': 'int64',
+                       'difference_value': 'float64',
+                       'view_render_a_attempt_number': 'int64',
+                       'view_render_b_attempt_number': 'int64',
+                       'compare_early_exit': 'bool',
+                       'phash_distance': 'int64',
+                       'baseline_cached': 'bool',
+                       'csv_rows_a': 'int64',
+                       'csv_rows_b': 'int64',
+                       'csv_differing_rows': 'int64'}
+REPORT_COLUMN_TYPES.update({column: 'float64' for column in
+                            ['view_render_a_signin_seconds', 'view_render_b_signin_seconds',
+                             'view_render_a_wait_seconds', 'view_render_b_wait_seconds',
+                             'view_render_a_request_seconds', 'view_render_b_request_seconds',
+                             'view_render_a_bytes_per_second', 'view_render_b_bytes_per_second',
+                             'view_render_a_write_seconds', 'view_render_b_write_seconds',
+                             'compare_seconds', 'task_seconds']})
+
+# rows buffered before the report writer flushes early, without waiting for --report-interval
+REPORT_BATCH_SIZE = 500
+
+
+class ReportWriter(Thread):
+    # the only thread that writes the report. Results are queued by the compare tasks and written in batches,
+    # at least every flush_interval seconds, so the file is opened once and rows can't interleave
+    def __init__(self, path, columns, report_format='csv', flush_interval=5):
+        Thread.__init__(self, name='ReportWriter', daemon=True)
+        self.path = path
+        self.columns = columns
+        self.report_format = report_format
+        self.flush_interval = flush_interval
+        self.queue = Queue()
+        self._file = None
+        self._writer = None
+
+    def write(self, row, on_written=None):
+        # on_written is called on this thread once the row is on disk
+        self.queue.put((row, on_written))
+
+    def sync(self):
+        # block until every row written so far is on disk
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        while not flushed.wait(1):
+            if not self.is_alive():
+                break
+
+    def close(self):
+        # flush what is left and wait for it to reach the disk
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        self.open()
+        try:
+            batch = []
+            written_callbacks = []
+            next_flush = time.monotonic() + self.flush_interval
+            while True:
+                try:
+                    row = self.queue.get(timeout=max(0, next_flush - time.monotonic()))
+                except Empty:
+                    row = False
+                flushed = None
+                if isinstance(row, threading.Event):
+                    flushed, row = row, False  # see sync
+                elif row:
+                    row, on_written = row
+                    batch.append(row)
+                    if on_written is not None:
+                        written_callbacks.append(on_written)
+                if row is None or flushed is not None or len(batch) >= REPORT_BATCH_SIZE or \
+                        time.monotonic() >= next_flush:
+                    if batch:
+                        self.flush(batch)
+                        batch = []
+                    for on_written in written_callbacks:
+                        on_written()
+                    written_callbacks = []
+                    next_flush = time.monotonic() + self.flush_interval
+                if flushed is not None:
+                    flushed.set()
+                if row is None:
+                    break
+        except Exception as e:
+            log.logger.error(f'Error encountered writing the report {self.path}: {e}, {sys.exc_info()}')
+        finally:
+            self.closeFile()
+
+    def open(self):
+        if self.report_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._schema = pa.schema([(column, REPORT_COLUMN_TYPES.get(column, 'string')) for column in self.columns])
+            # parquet files can't be appended to, a resumed run rewrites the rows it already has
+            existing = pq.read_table(self.path) if os.path.isfile(self.path) else None
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+            if existing is not None:
+                self._writer.write_table(existing.cast(self._schema))
+            return
+
+        new_file = not os.path.isfile(self.path)
+        self._file = open(self.path, 'a', newline='')
+        if self.report_format == 'csv':
+            self._writer = csv.writer(self._file)
+            if new_file:
+                self._writer.writerow(self.columns)
+
+    def flush(self, batch):
+        if self.report_format == 'parquet':
+            import pyarrow as pa
+            columns = {column: [self.toColumnType(row[index], column) for row in batch]
+                       for index, column in enumerate(self.columns)}
+            self._writer.write_table(pa.Table.from_pydict(columns, schema=self._schema))
+            return
+
+        if self.report_format == 'csv':
+            self._writer.writerows(batch)
+        else:
+            for row in batch:
+                self._file.write(json.dumps(dict(zip(self.columns, row)), default=str) + '\n')
+        self._file.flush()
+
+    def toColumnType(self, value, column):
+        column_type = REPORT_COLUMN_TYPES.get(column, 'string')
+        if value is None or value == '':
+            return None
+        elif column_type == 'string':
+            return str(value)
+        elif column_type == 'bool':
+            return bool(value)
+        elif column_type == 'int64':
+            return int(value)
+        return float(value)
+
+    def closeFile(self):
+        if self._file is not None:
+            self._file.close()
+        elif self._writer is not None:
+            self._writer.close()
+
+
+def discoverViews(add_pair=None):
+    # list the views on both servers at once, enqueueing each matched pair as soon as both sides of it are known.
+    # add_pair replaces the enqueueing, so --role coordinator can write the pairs to shards instead
+    add_pair = add_pair or enqueueCompareViewPair
+    matcher = ViewMatcher(args.mm)
+    view_list = readViewList(args.vi) if args.vi else None
+
+    try:
+        with ThreadPoolExecutor(args.dt, 'SiteDiscovery') as site_executor, \
+                ThreadPoolExecutor(args.dt, 'WorkbookDiscovery') as workbook_executor:
+            site_futures = {}
+            server_sites = site_executor.map(getSites, [args.sa, args.sb])
+            for side, servername, sites in zip(['a', 'b'], [args.sa, args.sb], server_sites):
+                for site in sites:
+                    if args.si:
+                        # if filtered to a site, skip all but the one we want
+                        if site.name != args.si:
+                            continue
+                    future = site_executor.submit(getSiteViews, servername, site, workbook_executor, view_list)
+                    site_futures[future] = (side, servername, site)
+
+            for future in as_completed(site_futures):
+                side, servername, site = site_futures[future]
+                try:
+                    site_views = future.result()
+                except Exception as e:
+                    log.logger.error(f'Unable to list views on {servername}, site {site.name}: {e}, {sys.exc_info()}')
+                    continue
+
+                for site_view_a, site_view_b in matcher.addViews(site_views, side):
+                    add_pair(site_view_a, site_view_b)
+
+        writeUnmatchedViews(matcher.getUnmatchedViews())
+        if task_store is not None:
+            task_store.setMeta('discovery_complete', time.strftime('%Y-%m-%d %H:%M:%S'))
+    finally:
+        work_tracker.close()
+
+
+def readViewList(filepath):
+    # read the view LUIDs to filter on from the first column of the --vi csv
+    log.logger.debug(f'filtering views to those provided in {filepath}')
+    view_list = set()
+    with open(filepath, newline='') as view_list_file:
+        for line in csv.reader(view_list_file):
+            view_list.add(line[0])
+    return view_list
+
+
+def getSiteViews(servername, site, workbook_executor, view_list=None):
+    # return the SiteViews found on a given site, filtered by project, workbook name, and view list
+    import tableauserverclient as TSC
+
+    req_option = TSC.RequestOptions()
+
+    # if workbook name passed, filter on it
+    if args.wi:
+        req_option.filter.add(TSC.Filter(TSC.RequestOptions.Field.Name,
+                                         TSC.RequestOptions.Operator.Equals,
+                                         args.wi))
+
+    # if filtering by project, add that criteria
+    if args.pi:
+        req_option.filter.add(TSC.Filter(TSC.RequestOptions.Field.ProjectName,
+                                         TSC.RequestOptions.Operator.Equals,
+                                         args.pi))
+
+    def listSiteContent(server):
+        log.logger.info(f"signed in to {servername}, {site.name}, {site.content_url}, {site.state}")
+        # get the server information
+        server_info = server.server_info.get()
+        if args.wi or args.pi:
+            # get the filtered workbooks, their views are derived from them below
+            return server, server_info, list(TSC.Pager(server.workbooks, req_option))
+        # no filtering, so just grab all the views on the site
+        return server, server_info, list(TSC.Pager(server.views))
+
+    server, server_info, site_content = session_pool.run(servername, site.content_url, listSiteContent)
+
+    if args.wi or args.pi:
+        filtered_views = []
+        for workbook_views in workbook_executor.map(lambda workbook: getWorkbookViews(servername, site, workbook),
+                                                    site_content):
+            filtered_views.extend(workbook_views)
+        log.logger.debug(f'Found {len(filtered_views)} views')
+    else:
+        filtered_views = site_content
+
+    # if filtering by file, remove any non-matches
+    if view_list is not None:
+        filtered_views = [view for view in filtered_views if view.id in view_list]
+        log.logger.debug(f'will run over {len(filtered_views)} views')
+
+    log.logger.debug(f'Final count is {len(filtered_views)} views on {servername}, {site.name}')
+
+    # now package up the return list views with their contextual information
+    return [SiteView(view, site, server, server_info) for view in filtered_views]
+
+
+def getWorkbookViews(servername, site, workbook):
+    def populateViews(server):
+        server.workbooks.populate_views(workbook)
+        return workbook.views
+
+    return session_pool.run(servername, site.content_url, populateViews)
 
 
 def makePath(path):
     if not os.path.exists(path):
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)  # another thread may create it between the check and here
+
+
+class CompareStats(object):
+    # counts how many comparisons per render type were settled by a content hash instead of a full compare
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.compared = {}
+        self.fast_path_hits = {}
+
+    def record(self, render_type, fast_path):
+        with self._lock:
+            self.compared[render_type] = self.compared.get(render_type, 0) + 1
+            if fast_path:
+                key = (render_type, fast_path)
+                self.fast_path_hits[key] = self.fast_path_hits.get(key, 0) + 1
+
+    def logSummary(self):
+        for render_type, compared in sorted(self.compared.items()):
+            hits = {fast_path: count for (hit_type, fast_path), count in self.fast_path_hits.items()
+                    if hit_type == render_type}
+            log.logger.info(f'{render_type} compare fast path: {sum(hits.values())} of {compared} comparisons '
+                            f'({100 * sum(hits.values()) / compared:.1f}%) skipped the full compare '
+                            f'(byte hash: {hits.get("bytes", 0)}, pixel hash: {hits.get("pixels", 0)}, '
+                            f'perceptual hash: {hits.get("phash", 0)})')
+
+
+@contextlib.contextmanager
+def timePhase(timings, phase):
+    # add the wall-clock time spent in the block to timings[phase]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+
+
+class TimingStats(object):
+    # wall-clock phase timings of every render per server, and of every compare, summarized at the end of the run
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}  # (server address or 'compare', phase) -> list of seconds, or bytes per second
+
+    def record(self, compare_task):
+        with self._lock:
+            for view_render in [compare_task.view_render_a, compare_task.view_render_b]:
+                if view_render.attempt_num != compare_task.attempt_num:
+                    continue  # reused from an earlier attempt, already counted
+                server_address = view_render.site_view.server.server_address
+                for phase, seconds in view_render.timings.items():
+                    self.samples.setdefault((server_address, phase), []).append(seconds)
+                if view_render.getThroughput() is not None:
+                    self.samples.setdefault((server_address, 'bytes_per_second'), []).append(
+                        view_render.getThroughput())
+            for phase, seconds in compare_task.timings.items():
+                self.samples.setdefault(('compare', phase), []).append(seconds)
+
+    def logSummary(self):
+        # statistics rather than numpy, which a run with --compare-engine wand doesn't need otherwise
+        import statistics
+
+        for (group, phase), samples in sorted(self.samples.items()):
+            # 'inclusive' interpolates between samples as numpy.percentile does. It needs two of them
+            percentiles = statistics.quantiles(samples * 2 if len(samples) == 1 else samples, n=100, method='inclusive')
+            p50, p90, p99 = percentiles[49], percentiles[89], percentiles[98]
+            log.logger.info(f'{group} {phase}: n={len(samples)} p50={p50:.3f} p90={p90:.3f} p99={p99:.3f} '
+                            f'max={max(samples):.3f}')
+
+
+class AdaptiveConcurrency(object):
+    # AIMD limit on the view pairs rendering at once on each server. A render error, or a request slower than the
+    # latency target, halves that server's limit; every other render raises it, by one per render until the first
+    # cut (slow start) and by about one per full window after that. A pair takes its slots on both servers at once,
+    # so its renders still start together and two pairs can't each hold the slot the other is waiting for
+    def __init__(self, floor, ceiling, latency_target=None):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.latency_target = latency_target
+        self._condition = threading.Condition()
+        self.limits = {}  # server address -> current limit, fractional between whole steps
+        self.in_flight = {}
+        self.slow_start = {}
+        self.last_decrease = {}
+
+    def tryAcquire(self, server_addresses):
+        with self._condition:
+            for server_address in server_addresses:
+                if server_address not in self.limits:
+                    self.limits[server_address] = self.floor
+                    self.in_flight[server_address] = 0
+                    self.slow_start[server_address] = True
+                    self.last_decrease[server_address] = 0
+                    log.logger.info(f'Concurrency on {server_address}: starting at {self.floor} '
+                                    f'(floor {self.floor}, ceiling {self.ceiling})')
+            for server_address in set(server_addresses):
+                wanted = server_addresses.count(server_address)  # both sides of a pair can be on the same server
+                if self.in_flight[server_address] + wanted > max(int(self.limits[server_address]), wanted):
+                    return False
+            for server_address in server_addresses:
+                self.in_flight[server_address] += 1
+            return True
+
+    def acquire(self, server_addresses):
+        with self._condition:
+            self._condition.wait_for(lambda: self.tryAcquire(server_addresses))
+
+    def release(self, view_render):
+        # give back a render's slot and adjust its server's limit to how the render went
+        server_address = view_render.site_view.server.server_address
+        seconds = view_render.timings.get('request')
+        with self._condition:
+            self.in_flight[server_address] -= 1
+            limit = self.limits[server_address]
+            if not view_render.succeeded:
+                reason = 'render error'
+            elif self.latency_target and seconds and seconds > self.latency_target:
+                reason = f'request took {seconds:.1f}s'
+            else:
+                reason = None
+
+            if reason is None:
+                increase = 1 if self.slow_start[server_address] else 1 / limit
+                new_limit = min(self.ceiling, limit + increase)
+            elif time.monotonic() - (seconds or 0) < self.last_decrease[server_address]:
+                new_limit = limit  # sent before the last cut, that cut already accounts for it
+            else:
+                new_limit = max(self.floor, limit / 2)
+                self.slow_start[server_address] = False
+                self.last_decrease[server_address] = time.monotonic()
+
+            if int(new_limit) != int(limit):
+                log.logger.info(f'Concurrency on {server_address}: {int(limit)} -> {int(new_limit)}'
+                                f'{f" ({reason})" if reason else ""}')
+            self.limits[server_address] = new_limit
+            self._condition.notify_all()
+
+
+class RetryPolicy(object):
+    # decides what follows each attempt at a view pair: which sides to render again, whether the attempts so far
+    # agree on a result, and how long to back off after failed renders
+    def __init__(self, max_retries, quorum=None, backoff=1, backoff_max=60):
+        self.max_retries = max_retries
+        self.quorum = quorum  # None keeps the old behaviour: stop at the first attempt without differences
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self.history = {}  # (view a id, view b id, render type) -> outcomes of the attempts so far
+
+    def decide(self, compare_task):
+        # returns (retry, reuse render a, reuse render b, delay in seconds) and sets compare_task.verdict on the last
+        # attempt: 'different' or 'same' by majority of the compared attempts (or the last one, without --quorum),
+        # 'error' when no attempt could be compared
+        view_render_a, view_render_b = compare_task.view_render_a, compare_task.view_render_b
+        key = (view_render_a.site_view.view.id, view_render_b.site_view.view.id, view_render_a.render_type)
+        render_failed = not (view_render_a.succeeded and view_render_b.succeeded)
+        # the compares catch their own errors, so a compare that ran into one still says it succeeded
+        compared = compare_task.succeeded and not compare_task.error_text
+        retries_left = self.max_retries - compare_task.attempt_num
+        with self._lock:
+            history = self.history.setdefault(key, {'same': 0, 'different': 0, 'last': None, 'render_errors': 0})
+            if render_failed:
+                history['render_errors'] += 1
+            elif compared:
+                history['last'] = 'different' if compare_task.difference_value > 0 else 'same'
+                history[history['last']] += 1
+
+            if render_failed or not compared:
+                retry = retries_left > 0
+            elif self.quorum is None:
+                retry = compare_task.difference_value > 0 and retries_left > 0
+            else:
+                # stop once either outcome has its quorum, or when neither can reach it with the retries left
+                votes = max(history['same'], history['different'])
+                retry = votes < self.quorum <= votes + retries_left
 
+            if retry:
+                log.logger.debug(f'Attempt {compare_task.attempt_num} of {key}: {history}')
+            else:
+                del self.history[key]
+                if history['last'] is None:
+                    compare_task.verdict = 'error'
+                elif self.quorum is None:
+                    compare_task.verdict = history['last']
+                else:
+                    compare_task.verdict = 'different' if history['different'] >= history['same'] else 'same'
+
+        # only a failed render is worth repeating, the side that rendered is reused
+        reuse_a = retry and render_failed and view_render_a.succeeded
+        reuse_b = retry and render_failed and view_render_b.succeeded
+        delay = 0
+        if retry and render_failed and self.backoff > 0:
+            # exponential backoff with jitter, so failed renders don't all come back to the server at once
+            ceiling = min(self.backoff_max, self.backoff * 2 ** (history['render_errors'] - 1))
+            delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        return retry, reuse_a, reuse_b, delay
+
+    def schedule(self, delay, enqueue, *enqueue_args, **enqueue_kwargs):
+        if delay <= 0:
+            enqueue(*enqueue_args, **enqueue_kwargs)
+            return
+        work_tracker.add()  # keeps the run going while the retry waits
+
+        def enqueueLater():
+            try:
+                enqueue(*enqueue_args, **enqueue_kwargs)
+            finally:
+                work_tracker.done()
+
+        timer = threading.Timer(delay, enqueueLater)
+        timer.daemon = True
+        timer.start()
+
+
+def perceptualHash(filepath, blob=None):
+    # 64-bit perceptual hash of a PNG render: which of the 8x8 lowest frequencies of its 32x32 grayscale thumbnail are
+    # above their median. Renders that look alike have hashes a few bits apart, whatever their exact pixels
+    from PIL import Image as PILImage
+    import numpy as np
+
+    with PILImage.open(io.BytesIO(blob) if blob is not None else filepath) as image:
+        thumbnail = np.asarray(image.convert('L').resize((32, 32), PILImage.LANCZOS), dtype=np.float64)
+    dct = np.cos(np.pi * np.outer(np.arange(32), 2 * np.arange(32) + 1) / 64)  # DCT-II basis for the thumbnail
+    frequencies = (dct @ thumbnail @ dct.T)[:8, :8].flatten()
+    bits = frequencies > np.median(frequencies)
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+class PerceptualHashIndex(object):
+    # the perceptual hash of every PNG render in the run, written to phash_index.csv at the end. The final attempts
+    # at structurally different pairs are also grouped by which hash bits changed between the servers, so views
+    # that regressed the same way land in the same cluster in phash_clusters.csv
+    def __init__(self, index_path, clusters_path, threshold):
+        self.index_path = index_path
+        self.clusters_path = clusters_path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.renders = {}  # (server address, view luid, attempt) -> row of phash_index.csv
+        self.structural = []  # (compare task, hash a ^ hash b) of the final attempt at each structural pair
+        self.triage = {}
 
-def enqueueCompareViewTasks(site_view_list_a, site_view_list_b):
-    # compare and match two lists of SiteViews, returning a list of view pairs that match in a dict
-    view_pair_site_list = []
+    def record(self, compare_task, final):
+        if compare_task.phash_a is None:
+            return
+        with self._lock:
+            for view_render, phash in [(compare_task.view_render_a, compare_task.phash_a),
+                                       (compare_task.view_render_b, compare_task.phash_b)]:
+                site_view = view_render.site_view
+                self.renders[(site_view.server.server_address, site_view.view.id, view_render.attempt_num)] = \
+                    [site_view.server.server_address, site_view.getSiteContentUrlString(), site_view.view.id,
+                     site_view.view.content_url, view_render.attempt_num, f'{phash:016x}']
+            if final:
+                self.triage[compare_task.triage] = self.triage.get(compare_task.triage, 0) + 1
+                if compare_task.triage == 'structural':
+                    self.structural.append((compare_task, compare_task.phash_a ^ compare_task.phash_b))
+
+    def clusters(self):
+        # greedy clustering: each pair joins the first cluster whose first pair changed within threshold bits of it
+        clusters = []
+        for compare_task, delta in sorted(self.structural, key=lambda item: item[0].view_render_a.site_view.view.id):
+            for cluster in clusters:
+                if bin(cluster[0][1] ^ delta).count('1') <= self.threshold:
+                    cluster.append((compare_task, delta))
+                    break
+            else:
+                clusters.append([(compare_task, delta)])
+        return sorted(clusters, key=len, reverse=True)
+
+    def write(self):
+        with open(self.index_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['server', 'site_content_url', 'view_luid', 'view_content_url', 'attempt_number', 'phash'])
+            writer.writerows(self.renders.values())
+
+        clusters = self.clusters()
+        with open(self.clusters_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['cluster', 'cluster_size', 'server_a_view_luid', 'server_b_view_luid',
+                             'server_a_view_content_url', 'phash_distance', 'phash_delta', 'diff_filepath'])
+            for number, cluster in enumerate(clusters):
+                for compare_task, delta in cluster:
+                    writer.writerow([number, len(cluster), compare_task.view_render_a.site_view.view.id,
+                                     compare_task.view_render_b.site_view.view.id,
+                                     compare_task.view_render_a.site_view.view.content_url,
+                                     compare_task.phash_distance, f'{delta:016x}', compare_task.diff_filepath])
+
+        log.logger.info(f'Perceptual hash triage: {self.triage.get("identical", 0)} identical, '
+                        f'{self.triage.get("cosmetic", 0)} cosmetic, {self.triage.get("structural", 0)} structural '
+                        f'pairs in {len(clusters)} clusters. See {self.clusters_path}')
+
+
+def hashImagePixels(filepath, blob=None):
+    # hash of the decoded pixels, so PNGs that only differ in metadata or compression still match
+    with openImage(filepath, blob) as image:
+        digest = hashlib.sha256(f'{image.width}x{image.height}'.encode())
+        digest.update(image.make_blob('RGBA'))
+        return digest.hexdigest()
+
+
+def openImage(filepath, blob=None):
+    # open a render from memory when we have its bytes, otherwise from disk
+    from wand.image import Image
+
+    if blob is not None:
+        return Image(blob=blob)
+    return Image(filename=filepath)
+
+
+# --cm metrics the numpy compare engine can compute
+NUMPY_COMPARE_METRICS = ['absolute', 'mean_absolute', 'mean_squared', 'root_mean_square', 'peak_absolute',
+                         'peak_signal_to_noise_ratio', 'normalized_cross_correlation']
+
+
+def loadImageArray(filepath, blob=None):
+    # decode a PNG into a height x width x channels uint8 array, keeping alpha only when the image has it
+    from PIL import Image as PILImage
+    import numpy as np
+
+    with PILImage.open(io.BytesIO(blob) if blob is not None else filepath) as image:
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        return np.asarray(image.convert('RGBA' if has_alpha else 'RGB'))
+
+
+def trimImageArray(array):
+    # crop away the border that matches the top-left pixel, like ImageMagick's trim
+    import numpy as np
+
+    mask = np.any(array != array[0, 0], axis=-1)
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return array[:1, :1]
+    return array[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+
+
+def compareImageArrays(array_a, array_b, compare_metric):
+    # return (difference_value, mask of differing pixels). Values are normalized to 0-1 like ImageMagick's, except
+    # absolute (a pixel count) and peak_signal_to_noise_ratio (dB). Identical images always give 0, so
+    # normalized_cross_correlation is reported as 1 - NCC
+    import numpy as np
+
+    if array_a.shape[:2] != array_b.shape[:2]:
+        raise ValueError(f'image widths or heights differ: {array_a.shape[1]}x{array_a.shape[0]}, '
+                         f'{array_b.shape[1]}x{array_b.shape[0]}')
+    if array_a.shape[2] != array_b.shape[2]:
+        # only one of the images has alpha, compare both with it
+        array_a = addOpaqueAlpha(array_a)
+        array_b = addOpaqueAlpha(array_b)
+
+    difference = np.abs(array_a.astype(np.int16) - array_b.astype(np.int16))
+    mask = difference.any(axis=-1)
+    if not mask.any():
+        return 0, mask
+
+    if compare_metric == 'absolute':
+        value = int(np.count_nonzero(mask))
+    elif compare_metric == 'mean_absolute':
+        value = np.mean(difference, dtype=np.float64) / 255
+    elif compare_metric in ('mean_squared', 'root_mean_square', 'peak_signal_to_noise_ratio'):
+        mean_squared = np.mean(np.square(difference, dtype=np.int32), dtype=np.float64) / 255 ** 2
+        if compare_metric == 'mean_squared':
+            value = mean_squared
+        elif compare_metric == 'root_mean_square':
+            value = math.sqrt(mean_squared)
+        else:
+            value = 10 * math.log10(1 / mean_squared)
+    elif compare_metric == 'peak_absolute':
+        value = int(difference.max()) / 255
+    elif compare_metric == 'normalized_cross_correlation':
+        correlations = []
+        for channel in range(array_a.shape[2]):
+            channel_a = array_a[..., channel].astype(np.float32)
+            channel_b = array_b[..., channel].astype(np.float32)
+            channel_a -= channel_a.mean()
+            channel_b -= channel_b.mean()
+            denominator = math.sqrt(float(np.sum(channel_a * channel_a, dtype=np.float64)) *
+                                    float(np.sum(channel_b * channel_b, dtype=np.float64)))
+            if denominator == 0:
+                # a flat channel only correlates with an identical one
+                correlations.append(1.0 if np.array_equal(channel_a, channel_b) else 0.0)
+            else:
+                correlations.append(float(np.sum(channel_a * channel_b, dtype=np.float64)) / denominator)
+        value = 1 - sum(correlations) / len(correlations)
+    else:
+        raise ValueError(f'Compare metric {compare_metric} is not supported by the numpy compare engine')
+    return value, mask
+
+
+# --cm metrics the tiled compare can add up across tiles
+TILED_COMPARE_METRICS = ['absolute', 'mean_absolute', 'mean_squared', 'root_mean_square', 'peak_absolute',
+                         'peak_signal_to_noise_ratio']
+
+
+def compareImageTiles(array_a, array_b, compare_metric, tile_size, early_exit=None):
+    # compareImageArrays tile by tile. Tiles whose bytes hash the same are skipped, and with early_exit the compare
+    # stops once more than that share of the tiles has changed. Returns (difference_value, mask of differing pixels,
+    # bounding boxes (x, y, width, height) of the changed regions, whether it stopped early)
+    import numpy as np
+
+    if array_a.shape[:2] != array_b.shape[:2]:
+        raise ValueError(f'image widths or heights differ: {array_a.shape[1]}x{array_a.shape[0]}, '
+                         f'{array_b.shape[1]}x{array_b.shape[0]}')
+    if array_a.shape[2] != array_b.shape[2]:
+        # only one of the images has alpha, compare both with it
+        array_a = addOpaqueAlpha(array_a)
+        array_b = addOpaqueAlpha(array_b)
+
+    height, width = array_a.shape[:2]
+    mask = np.zeros((height, width), dtype=bool)
+    tile_count = math.ceil(height / tile_size) * math.ceil(width / tile_size)
+    changed = {}  # (tile row, tile column) -> pixel bounding box (x0, y0, x1, y1) of the changes in the tile
+    differing_pixels, absolute_sum, squared_sum, peak = 0, 0, 0, 0
+    exited_early = False
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            tile_a = np.ascontiguousarray(array_a[top:top + tile_size, left:left + tile_size])
+            tile_b = np.ascontiguousarray(array_b[top:top + tile_size, left:left + tile_size])
+            if hashlib.blake2b(tile_a).digest() == hashlib.blake2b(tile_b).digest():
+                continue
 
-    for site_view_a in site_view_list_a:
-        for site_view_b in site_view_list_b:
-            # match views
-            if (args.mm == 'luid' and site_view_a.view.id == site_view_b.view.id) or \
-                    (args.mm == 'content_url' and site_view_a.view.content_url == site_view_b.view.content_url):
-                if args.cv:
-                    enqueueCompareViewTask(site_view_a, site_view_b, 'png', args.cm)
-                if args.cd:
-                    enqueueCompareViewTask(site_view_a, site_view_b, 'csv')
+            difference = np.abs(tile_a.astype(np.int16) - tile_b.astype(np.int16))
+            tile_mask = difference.any(axis=-1)
+            if not tile_mask.any():
+                continue
+            mask[top:top + tile_size, left:left + tile_size] = tile_mask
+            differing_pixels += int(np.count_nonzero(tile_mask))
+            absolute_sum += int(difference.sum(dtype=np.int64))
+            squared_sum += int(np.square(difference, dtype=np.int32).sum(dtype=np.int64))
+            peak = max(peak, int(difference.max()))
+            rows = np.flatnonzero(tile_mask.any(axis=1))
+            columns = np.flatnonzero(tile_mask.any(axis=0))
+            changed[(top // tile_size, left // tile_size)] = (left + columns[0], top + rows[0],
+                                                              left + columns[-1] + 1, top + rows[-1] + 1)
+
+            if early_exit is not None and len(changed) > early_exit * tile_count:
+                exited_early = True
+                break
+        if exited_early:
+            break
+
+    if not changed:
+        return 0, mask, [], False
+
+    samples = height * width * array_a.shape[2]
+    if compare_metric == 'absolute':
+        value = differing_pixels
+    elif compare_metric == 'mean_absolute':
+        value = absolute_sum / samples / 255
+    elif compare_metric == 'peak_absolute':
+        value = peak / 255
+    else:
+        mean_squared = squared_sum / samples / 255 ** 2
+        if compare_metric == 'mean_squared':
+            value = mean_squared
+        elif compare_metric == 'root_mean_square':
+            value = math.sqrt(mean_squared)
+        else:
+            value = 10 * math.log10(1 / mean_squared)
+    return value, mask, mergeTileRegions(changed), exited_early
 
 
-def enqueueCompareViewTask(site_view_a, site_view_b, render_type, compare_metric=None, attempt_num=0):
-    # add a pair of views to the queue for comparison
-    view_render_a = ViewRenderer(site_view_a, render_type, attempt_num)
-    view_render_b = ViewRenderer(site_view_b, render_type, attempt_num)
+def mergeTileRegions(changed):
+    # one bounding box per group of touching changed tiles (including diagonally)
+    regions = []
+    unvisited = set(changed)
+    while unvisited:
+        pending = [unvisited.pop()]
+        x0, y0, x1, y1 = changed[pending[0]]
+        while pending:
+            row, column = pending.pop()
+            box = changed[(row, column)]
+            x0, y0, x1, y1 = min(x0, box[0]), min(y0, box[1]), max(x1, box[2]), max(y1, box[3])
+            for neighbour in [(row + dy, column + dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]:
+                if neighbour in unvisited:
+                    unvisited.remove(neighbour)
+                    pending.append(neighbour)
+        regions.append((int(x0), int(y0), int(x1 - x0), int(y1 - y0)))
+    return sorted(regions, key=lambda region: (region[1], region[0]))
+
+
+def maskBoundingBox(mask):
+    # (x, y, width, height) of the smallest box holding every changed pixel of a mask, or all of it if none changed
+    import numpy as np
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return 0, 0, mask.shape[1], mask.shape[0]
+    return (int(columns[0]), int(rows[0]), int(columns[-1] - columns[0] + 1), int(rows[-1] - rows[0] + 1))
+
+
+def addOpaqueAlpha(array):
+    import numpy as np
+
+    if array.shape[2] == 4:
+        return array
+    return np.dstack([array, np.full(array.shape[:2], 255, np.uint8)])
+
+
+def saveDiffImage(array_a, mask, filepath):
+    # the reference image faded towards white, with differing pixels highlighted in red like ImageMagick's compare
+    from PIL import Image as PILImage
+    import numpy as np
+
+    highlight = (array_a[..., :3] * 0.3 + 255 * 0.7).astype(np.uint8)
+    highlight[mask] = (241, 0, 30)
+    PILImage.fromarray(highlight).save(filepath)
+
+
+def csvSource(filepath, content=None):
+    # what pandas should read a render from: its bytes when we have them, otherwise the file on disk
+    if content is not None:
+        return io.BytesIO(content)
+    return filepath
+
+
+def readCsvColumns(filepath, content=None):
+    # column names of a csv render, none for a blank one
+    import pandas as pd
+
+    try:
+        return list(pd.read_csv(csvSource(filepath, content), nrows=0).columns)
+    except pd.errors.EmptyDataError:
+        return []
+
+
+def readCsvChunks(filepath, content, columns):
+    # the given columns of a csv render, --csv-chunksize rows at a time, as strings exactly as exported
+    import pandas as pd
+
+    if not columns:
+        return
+    with pd.read_csv(csvSource(filepath, content), usecols=columns, dtype=str, keep_default_na=False,
+                     chunksize=args.csv_chunksize) as reader:
+        for chunk in reader:
+            yield chunk[columns]  # in the same order on both sides
+
+
+def hashCsvRows(chunk, columns):
+    # one 64-bit hash per row. Numbers are rounded, as the pandas engine does with float columns, and thousands
+    # separators dropped, so that only real differences change the hash
+    import numpy as np
+    import pandas as pd
+
+    normalized = {}
+    for column in columns:
+        values = chunk[column]
+        numbers = pd.to_numeric(values.str.replace(',', '', regex=False), errors='coerce')
+        numeric = numbers.notna() & np.isfinite(numbers) & (numbers.abs() < 2 ** 63)
+        if numeric.any():
+            values = values.where(~numeric, numbers.where(numeric, 0).round().astype('int64').astype(str))
+        normalized[column] = values
+    return pd.util.hash_pandas_object(pd.DataFrame(normalized), index=False).to_numpy()
+
+
+def hashCsvFile(filepath, content, columns):
+    # the hash of every row of a csv render, in order. Only these 8 bytes per row are held in memory, never the rows
+    import numpy as np
+
+    hashes = [hashCsvRows(chunk, columns) for chunk in readCsvChunks(filepath, content, columns)]
+    return np.concatenate(hashes) if hashes else np.array([], dtype='uint64')
+
+
+def selectCsvRows(filepath, content, columns, hashes, wanted):
+    # the rows of a csv render whose hash is in wanted, at most as many times as wanted counts it
+    import numpy as np
+
+    remaining = wanted.astype('int64').to_dict()
+    if not remaining:
+        return
+    selected = []
+    for position in np.flatnonzero(np.isin(hashes, wanted.index.to_numpy())):
+        if remaining[hashes[position]] > 0:
+            remaining[hashes[position]] -= 1
+            selected.append(position)
+    selected = np.array(selected, dtype='int64')
+
+    start = 0
+    for chunk in readCsvChunks(filepath, content, columns):
+        in_chunk = selected[(selected >= start) & (selected < start + len(chunk))] - start
+        start += len(chunk)
+        if len(in_chunk):
+            yield chunk.iloc[in_chunk].copy()
+
+
+class ViewMatcher(object):
+    # hash join of server A views to server B views on the --mm match key. Views are indexed as they are added and
+    # probed against the other side's index, so each list is walked once instead of comparing every pair
+    def __init__(self, match_method):
+        self.match_method = match_method
+        self.index_a = {}
+        self.index_b = {}
+
+    def getMatchKey(self, site_view):
+        if self.match_method == 'luid':
+            return site_view.view.id
+        return site_view.view.content_url
+
+    def addViews(self, site_views, side):
+        # index the views for one side ('a' or 'b') and return the (site_view_a, site_view_b) pairs they complete
+        index, other_index = (self.index_a, self.index_b) if side == 'a' else (self.index_b, self.index_a)
+        view_pairs = []
+        for site_view in site_views:
+            key = self.getMatchKey(site_view)
+            index.setdefault(key, []).append(site_view)
+            for other_site_view in other_index.get(key, []):
+                if side == 'a':
+                    view_pairs.append((site_view, other_site_view))
+                else:
+                    view_pairs.append((other_site_view, site_view))
+        return view_pairs
+
+    def getUnmatchedViews(self):
+        # return the (side, site_view) of every view that has no match on the other server
+        unmatched = []
+        for side, index, other_index in (('a', self.index_a, self.index_b), ('b', self.index_b, self.index_a)):
+            for key, site_views in index.items():
+                if key not in other_index:
+                    unmatched.extend((side, site_view) for site_view in site_views)
+        return unmatched
+
+
+def enqueueCompareViewPair(site_view_a, site_view_b, shard=None):
+    render_types = []
+    if args.cv:
+        render_types.append(('png', args.cm))
+    if args.cd:
+        render_types.append(('csv', None))
+
+    for render_type, compare_metric in render_types:
+        # skip anything the manifest says is already done
+        attempt_num = run_manifest.getStartAttempt(site_view_a, site_view_b, render_type)
+        if task_store is not None and task_store.isKnown(site_view_a, site_view_b, render_type):
+            attempt_num = None  # requeued from the task store, see TaskStore.restore
+        if attempt_num is None:
+            log.logger.debug(f'Skipping finished {render_type} comparison of {site_view_a.view.id}, {site_view_b.view.id}')
+            continue
+        if shard is not None:
+            shard_worker.add(shard)
+        enqueueCompareViewTask(site_view_a, site_view_b, render_type, compare_metric, attempt_num=attempt_num,
+                               shard=shard)
+
+
+def writeUnmatchedViews(unmatched):
+    # views found on only one server are never compared, so list them separately from report.csv
+    log.logger.info(f'{len(unmatched)} views have no match on the other server. See {unmatched_path}')
+    with open(unmatched_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['server', 'site_content_url', 'view_luid', 'view_content_url', 'view_updated_at', 'view_url'])
+        for side, site_view in unmatched:
+            writer.writerow([site_view.server.server_address,
+                             site_view.getSiteContentUrlString(),
+                             site_view.view.id,
+                             site_view.view.content_url,
+                             site_view.view.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+                             site_view.getUrl()])
+
+
+def enqueueCompareViewTask(site_view_a, site_view_b, render_type, compare_metric=None, attempt_num=0,
+                           view_render_a=None, view_render_b=None, shard=None):
+    # add a pair of views to the queue for comparison. view_render_a / view_render_b are finished renders from an
+    # earlier attempt to reuse instead of rendering that side again. shard is where a --role worker got the pair
+    view_render_a = view_render_a or ViewRenderer(site_view_a, render_type, attempt_num)
+    view_render_b = view_render_b or ViewRenderer(site_view_b, render_type, attempt_num, baseline=True)
     #    def __init__(self, view_render_a, view_render_b, diff_filepath, compare_metric=None, attempt_num=0):
     compare_task = CompareTask(view_render_a, view_render_b,
-                               f"{view_render_a.getOutputFilePath(server_name='differences', diff=True)}",
+                               f"{view_render_a.getOutputFilePath(server_name='differences', diff=True, attempt_num=attempt_num)}",
                                compare_metric, attempt_num)
+    compare_task.shard = shard
     log.logger.info(f"Enqueuing new render pair task of type PNG for {site_view_a.view.id}, {site_view_b.view.id}")
+    work_tracker.add()
     task_queue.put(compare_task)
 
 
@@ -0,0 +1,232 @@
+#########################################################################################################
+# TabCompare compare benchmark
+# Times CompareTask.compare_images / compare_images_numpy (whole and tiled) and compare_csvs / compare_csvs_hash on
+# synthetic PNG and CSV pairs of varied sizes and kinds of difference, for each --cm metric. Nothing is rendered, so
+# no Tableau Server is needed.
+#
+# Example:
+#
+#   python benchmarks/bench_compare.py --image-sizes 800x600 3200x2400 --csv-rows 1000 100000 --output bench_compare.json
+#
+#########################################################################################################
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import TabCompare  # noqa: E402
+import log  # noqa: E402
+
+IMAGE_KINDS = ['identical', 'sparse_noise', 'shifted', 'resized']
+CSV_KINDS = ['identical', 'sparse_changes', 'shuffled', 'extra_rows']
+METRICS = ['absolute', 'mean_absolute', 'mean_squared', 'root_mean_square', 'peak_absolute',
+           'peak_signal_to_noise_ratio', 'normalized_cross_correlation']
+
+# engine -> (CompareTask method, TabCompare arguments it runs with, metrics it supports)
+IMAGE_ENGINES = {
+    'wand': ('compare_images', {}, METRICS),
+    'numpy': ('compare_images_numpy', {}, TabCompare.NUMPY_COMPARE_METRICS),
+    'numpy_tiled': ('compare_images_numpy', {'tile_size': 64}, TabCompare.TILED_COMPARE_METRICS),
+    'numpy_tiled_early_exit': ('compare_images_numpy', {'tile_size': 64, 'early_exit': 0.05},
+                               TabCompare.TILED_COMPARE_METRICS),
+}
+CSV_ENGINES = {
+    'pandas': 'compare_csvs',
+    'hash': 'compare_csvs_hash',
+}
+
+
+def makeDashboard(width, height, seed):
+    # something like a rendered view: a white background with a title bar, gridlines and bars
+    rng = np.random.default_rng(seed)
+    array = np.full((height, width, 3), 255, np.uint8)
+    array[:max(1, height // 12)] = (31, 119, 180)
+    for y in range(height // 6, height, max(1, height // 10)):
+        array[y, width // 10:] = (220, 220, 220)
+    bars = 12
+    bar_width = max(1, (width - width // 10) // (bars * 2))
+    for bar in range(bars):
+        left = width // 10 + bar * 2 * bar_width
+        top = int(rng.integers(height // 6, height - 1))
+        array[top:height - height // 20, left:left + bar_width] = rng.integers(0, 200, 3)
+    return array
+
+
+def makeImagePair(kind, width, height):
+    from PIL import Image as PILImage
+
+    array_a = makeDashboard(width, height, 0)
+    if kind == 'identical':
+        array_b = array_a.copy()
+    elif kind == 'sparse_noise':
+        # 0.1% of the pixels changed
+        rng = np.random.default_rng(1)
+        array_b = array_a.copy()
+        pixels = rng.choice(width * height, max(1, width * height // 1000), replace=False)
+        array_b.reshape(-1, 3)[pixels] = rng.integers(0, 256, (len(pixels), 3))
+    elif kind == 'shifted':
+        # everything moved 3 pixels right, as when a layout changes
+        array_b = np.full_like(array_a, 255)
+        array_b[:, 3:] = array_a[:, :-3]
+    else:
+        # rendered at 90% of the size
+        with PILImage.fromarray(array_a) as image:
+            array_b = np.asarray(image.resize((width * 9 // 10, height * 9 // 10)))
+    return array_a, array_b
+
+
+def makeCsvPair(kind, rows, columns):
+    rng = np.random.default_rng(0)
+    data = {'Category': [f'C{row % 997}' for row in range(rows)], 'Region': [f'R{row % 7}' for row in range(rows)]}
+    for column in range(columns - 2):
+        data[f'Measure{column}'] = rng.normal(1000, 250, rows).round(4)
+    dataframe_a = pd.DataFrame(data)
+    if kind == 'identical':
+        dataframe_b = dataframe_a.copy()
+    elif kind == 'sparse_changes':
+        # 0.1% of the rows get a different first measure
+        dataframe_b = dataframe_a.copy()
+        changed = rng.choice(rows, max(1, rows // 1000), replace=False)
+        dataframe_b.loc[changed, 'Measure0'] += 1
+    elif kind == 'shuffled':
+        # same rows, another order
+        dataframe_b = dataframe_a.sample(frac=1, random_state=1).reset_index(drop=True)
+    else:
+        # 1% more rows on server B
+        dataframe_b = pd.concat([dataframe_a, dataframe_a.head(max(1, rows // 100))], ignore_index=True)
+    return dataframe_a, dataframe_b
+
+
+def timeCompare(method, compare_args, settings, diff_filepath, repeat):
+    # run CompareTask.<method> repeat times, each on a new task, and return the seconds of each run and the last task
+    TabCompare.args = argparse.Namespace(**settings)
+    seconds = []
+    compare_task = None
+    for _ in range(repeat):
+        compare_task = TabCompare.CompareTask(None, None, diff_filepath)
+        start = time.perf_counter()
+        try:
+            getattr(compare_task, method)(*compare_args)
+        except Exception as e:
+            # compare_csvs raises after setting error_text, the image compares only set it
+            compare_task.error_text = compare_task.error_text or str(e)
+        seconds.append(time.perf_counter() - start)
+        if compare_task.error_text:
+            break
+    return seconds, compare_task
+
+
+def makeResult(case, seconds, compare_task):
+    return dict(case,
+                seconds_min=min(seconds),
+                seconds_median=float(np.median(seconds)),
+                runs=len(seconds),
+                difference_value=float(compare_task.difference_value),
+                early_exit=compare_task.early_exit,
+                failed=bool(compare_task.error_text),
+                error=compare_task.error_text[:300])
+
+
+def benchmarkImages(args, work_dir):
+    from PIL import Image as PILImage
+
+    for size in args.image_sizes:
+        width, height = (int(number) for number in size.lower().split('x'))
+        for kind in args.image_kinds:
+            path_a = os.path.join(work_dir, f'{size}_{kind}_a.png')
+            path_b = os.path.join(work_dir, f'{size}_{kind}_b.png')
+            for array, path in zip(makeImagePair(kind, width, height), (path_a, path_b)):
+                PILImage.fromarray(array).save(path)
+            for engine in args.image_engines:
+                method, engine_settings, supported_metrics = IMAGE_ENGINES[engine]
+                for metric in args.metrics:
+                    if metric not in supported_metrics:
+                        continue
+                    settings = dict({'tile_size': 0, 'early_exit': None, 'artifact_store': False}, **engine_settings)
+                    seconds, compare_task = timeCompare(method, (path_a, path_b, metric), settings,
+                                                        os.path.join(work_dir, 'diff.png'), args.repeat)
+                    yield makeResult({'type': 'image', 'engine': engine, 'metric': metric, 'kind': kind,
+                                      'size': size, 'pixels': width * height}, seconds, compare_task)
+
+
+def benchmarkCsvs(args, work_dir):
+    for rows in args.csv_rows:
+        for columns in args.csv_columns:
+            for kind in args.csv_kinds:
+                path_a = os.path.join(work_dir, f'{rows}x{columns}_{kind}_a.csv')
+                path_b = os.path.join(work_dir, f'{rows}x{columns}_{kind}_b.csv')
+                for dataframe, path in zip(makeCsvPair(kind, rows, columns), (path_a, path_b)):
+                    dataframe.to_csv(path, index=False)
+                for engine in args.csv_engines:
+                    seconds, compare_task = timeCompare(CSV_ENGINES[engine], (path_a, path_b),
+                                                        {'csv_chunksize': args.csv_chunksize},
+                                                        os.path.join(work_dir, 'diff.csv'), args.repeat)
+                    yield makeResult({'type': 'csv', 'engine': engine, 'kind': kind, 'rows': rows,
+                                      'columns': columns}, seconds, compare_task)
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the TabCompare image and CSV compares on synthetic pairs')
+    parser.add_argument('--image-sizes', nargs='*', default=['400x300', '1600x1200', '3200x2400'],
+                        help='(optional) Image sizes, as WIDTHxHEIGHT. Default value: 400x300 1600x1200 3200x2400')
+    parser.add_argument('--image-kinds', nargs='*', choices=IMAGE_KINDS, default=IMAGE_KINDS,
+                        help='(optional) Kinds of image pair. Default: all')
+    parser.add_argument('--image-engines', nargs='*', choices=list(IMAGE_ENGINES), default=list(IMAGE_ENGINES),
+                        help='(optional) Image compare engines. Default: all')
+    parser.add_argument('--metrics', nargs='*', choices=METRICS, default=METRICS,
+                        help='(optional) --cm metrics to time. Default: all that an engine supports')
+    parser.add_argument('--csv-rows', type=int, nargs='*', default=[1000, 100000],
+                        help='(optional) CSV row counts. Default value: 1000 100000')
+    parser.add_argument('--csv-columns', type=int, nargs='*', default=[5, 20],
+                        help='(optional) CSV column counts (at least 3). Default value: 5 20')
+    parser.add_argument('--csv-kinds', nargs='*', choices=CSV_KINDS, default=CSV_KINDS,
+                        help='(optional) Kinds of CSV pair. Default: all')
+    parser.add_argument('--csv-engines', nargs='*', choices=list(CSV_ENGINES), default=list(CSV_ENGINES),
+                        help='(optional) CSV compare engines. Default: all')
+    parser.add_argument('--csv-chunksize', type=int, default=100000,
+                        help='(optional) --csv-chunksize for the hash engine. Default value: 100000')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='(optional) Runs of each compare, the minimum and median are reported. Default value: 3')
+    parser.add_argument('--output', help='(optional) Write the results to this JSON file')
+    args = parser.parse_args()
+
+    if any(columns < 3 for columns in args.csv_columns):
+        parser.error('--csv-columns must be at least 3')
+
+    # the compares log their errors, which are reported with the results instead
+    log.logger = logging.getLogger('bench_compare')
+    log.logger.addHandler(logging.NullHandler())
+    log.logger.propagate = False
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for result in itertools.chain(benchmarkImages(args, work_dir), benchmarkCsvs(args, work_dir)):
+            results.append(result)
+            print(' '.join(f'{key}={formatValue(value)}' for key, value in result.items()), flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                                       'numpy': np.__version__, 'pandas': pd.__version__},
+                       'settings': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#########################################################################################################
+# TabCompare end-to-end benchmark
+# Runs TabCompare against two local mock Tableau Servers (see mock_server.py) for a set of scenarios and reports
+# view pairs compared per second, per-pair latency percentiles, peak RSS and CPU use of the TabCompare process.
+#
+# Example:
+#
+#   python benchmarks/bench_e2e.py --views 10 --latency 0.05 --output bench_e2e.json
+#
+#########################################################################################################
+
+import argparse
+import csv
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+TABCOMPARE = os.path.join(os.path.dirname(BENCHMARK_DIR), 'TabCompare.py')
+
+# name -> (TabCompare arguments, extra mock server A arguments, extra mock server B arguments)
+SCENARIOS = {
+    'data_nt1': (['--cd', '--nt', '1', '--nr', '0'], [], []),
+    'data_nt4': (['--cd', '--nt', '4', '--nr', '0'], [], []),
+    'data_nt8': (['--cd', '--nt', '8', '--nr', '0'], [], []),
+    'data_async_nt8': (['--cd', '--nt', '8', '--nr', '0', '--engine', 'async'], [], []),
+    'images_nt4': (['--cv', '--nt', '4', '--nr', '0', '--compare-engine', 'numpy', '--cm', 'mean_absolute'],
+                   [], ['--variant', 'b']),
+    'images_data_nt8': (['--cv', '--cd', '--nt', '8', '--nr', '0', '--compare-engine', 'numpy',
+                         '--cm', 'mean_absolute'], [], []),
+    'data_retries_nt4': (['--cd', '--nt', '4', '--nr', '2', '--backoff', '0.1'], ['--errors', '0.1'],
+                         ['--csv-diff', '1']),
+}
+
+
+def getFreePort():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def startMockServer(port, mock_args):
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, 'mock_server.py'), '--port', str(port)]
+                               + mock_args)
+    # wait until it accepts connections
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(.05)
+    process.kill()
+    raise RuntimeError(f'Mock server on port {port} did not start')
+
+
+def readReport(report_path):
+    # per view pair: the seconds of every attempt at it added up
+    pair_seconds = {}
+    with open(report_path, newline='') as f:
+        for row in csv.DictReader(f):
+            key = (row['server_a_view_luid'], row['server_b_view_luid'], row['diff_filepath'][-3:])
+            pair_seconds[key] = pair_seconds.get(key, 0) + float(row['task_seconds'] or 0)
+    return list(pair_seconds.values())
+
+
+def runScenario(name, tabcompare_args, mock_args_a, mock_args_b, common_mock_args, timeout):
+    port_a, port_b = getFreePort(), getFreePort()
+    mock_a = startMockServer(port_a, common_mock_args + mock_args_a)
+    mock_b = startMockServer(port_b, common_mock_args + mock_args_b)
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            command = [sys.executable, TABCOMPARE, '--sa', f'http://127.0.0.1:{port_a}',
+                       '--sb', f'http://127.0.0.1:{port_b}', '--u', 'bench', '--p', 'bench',
+                       '--f', os.path.join(output_dir, 'out'), '--l', os.path.join(output_dir, 'logs', 'TabCompare'),
+                       '--ll', 'ERROR'] + tabcompare_args
+            start = time.perf_counter()
+            errors_path = os.path.join(output_dir, 'stderr.txt')
+            with open(errors_path, 'w') as errors:
+                process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=errors)
+            # wait4 gives the resource use of this child alone, unlike RUSAGE_CHILDREN
+            deadline = time.monotonic() + timeout
+            while True:
+                pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+                if pid:
+                    break
+                if time.monotonic() > deadline:
+                    process.kill()
+                    pid, status, usage = os.wait4(process.pid, 0)
+                    break
+                time.sleep(.01)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            wall_seconds = time.perf_counter() - start
+
+            if process.returncode:
+                with open(errors_path) as errors:
+                    print(f'{name} failed with exit code {process.returncode}:\n{errors.read()[-4000:]}',
+                          file=sys.stderr)
+
+            report_path = os.path.join(output_dir, 'out', 'report.csv')
+            pair_seconds = readReport(report_path) if os.path.isfile(report_path) else []
+    finally:
+        mock_a.kill()
+        mock_b.kill()
+        mock_a.wait()
+        mock_b.wait()
+
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    p50, p95, p99 = np.percentile(pair_seconds, [50, 95, 99]) if pair_seconds else (None, None, None)
+    return {'scenario': name,
+            'arguments': ' '.join(tabcompare_args),
+            'exit_code': process.returncode,
+            'view_pairs': len(pair_seconds),
+            'wall_seconds': wall_seconds,
+            'view_pairs_per_second': len(pair_seconds) / wall_seconds,
+            'pair_seconds_p50': p50,
+            'pair_seconds_p95': p95,
+            'pair_seconds_p99': p99,
+            'peak_rss_mb': usage.ru_maxrss / 1024,  # ru_maxrss is in KB on Linux
+            'cpu_seconds': cpu_seconds,
+            'cpu_percent': 100 * cpu_seconds / wall_seconds}
+
+
+def formatValue(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f'{value:.3f}'
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end TabCompare benchmark against local mock servers')
+    parser.add_argument('--scenarios', nargs='*', choices=sorted(SCENARIOS), default=sorted(SCENARIOS),
+                        help='(optional) Scenarios to run. Default: all')
+    parser.add_argument('--sites', type=int, default=2, help='(optional) Sites on each mock server. Default value: 2')
+    parser.add_argument('--workbooks', type=int, default=4,
+                        help='(optional) Workbooks per site on each mock server. Default value: 4')
+    parser.add_argument('--views', type=int, default=5,
+                        help='(optional) Views per workbook on each mock server. Default value: 5')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='(optional) Mean render latency of the mock servers in seconds. Default value: 0.05')
+    parser.add_argument('--png-size', type=int, nargs=2, default=[800, 600], metavar=('WIDTH', 'HEIGHT'),
+                        help='(optional) Size of the mock view images. Default value: 800 600')
+    parser.add_argument('--csv-rows', type=int, default=200,
+                        help='(optional) Rows of mock view data. Default value: 200')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='(optional) Seconds before a scenario is stopped. Default value: 600')
+    parser.add_argument('--output', help='(optional) Write the results to this JSON file')
+    args = parser.parse_args()
+
+    common_mock_args = ['--sites', str(args.sites), '--workbooks', str(args.workbooks), '--views', str(args.views),
+                        '--latency', str(args.latency), '--latency-jitter', str(args.latency / 4),
+                        '--png-width', str(args.png_size[0]), '--png-height', str(args.png_size[1]),
+                        '--csv-rows', str(args.csv_rows)]
+
+    results = []
+    for name in args.scenarios:
+        tabcompare_args, mock_args_a, mock_args_b = SCENARIOS[name]
+        result = runScenario(name, tabcompare_args, mock_args_a, mock_args_b, common_mock_args, args.timeout)
+        results.append(result)
+        print(' '.join(f'{key}={formatValue(value)}' for key, value in result.items() if key != 'arguments'),
+              flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'settings': vars(args), 'results': results},
+                      f, indent=2)
+
+    # fail (for CI) when any scenario did
+    return 1 if any(result['exit_code'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#########################################################################################################
+# TabCompare startup benchmark
+# Runs a small TabCompare run (one view pair by default) against two local mock Tableau Servers for each mode
+# combination, as TabCompare loads its dependencies ('lazy') and with tableauserverclient, pandas, numpy and Wand
+# imported up front as they used to be ('eager'). Reports wall-clock time, peak RSS and which heavy packages each
+# run imported, and how long they took to import (from python -X importtime).
+#
+# Example:
+#
+#   python benchmarks/bench_startup.py --repeat 5 --output bench_startup.json
+#
+#########################################################################################################
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from bench_e2e import TABCOMPARE, getFreePort, startMockServer
+
+HEAVY_PACKAGES = ['tableauserverclient', 'pandas', 'numpy', 'wand', 'PIL', 'requests']
+
+# name -> TabCompare arguments
+MODES = {
+    'cv_wand': ['--cv'],
+    'cv_numpy': ['--cv', '--compare-engine', 'numpy', '--cm', 'mean_absolute'],
+    'cd_pandas': ['--cd'],
+    'cd_hash': ['--cd', '--csv-engine', 'hash'],
+    'cv_cd': ['--cv', '--cd', '--compare-engine', 'numpy', '--cm', 'mean_absolute'],
+    'export': ['--role', 'export'],
+}
+
+# imports everything the way TabCompare did at module load, then runs it
+EAGER_PRELUDE = '''
+import tableauserverclient, pandas, numpy
+try:
+    import wand.image
+except ImportError:
+    pass  # --cv with --compare-engine wand then fails in both variants
+import runpy, sys
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+
+def readImportTimes(importtime_output):
+    # seconds each heavy package took to import, including everything it imported
+    seconds = {}
+    for line in importtime_output.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)$', line)
+        if match and match.group(2) in HEAVY_PACKAGES:
+            seconds.setdefault(match.group(2), int(match.group(1)) / 1e6)
+    return seconds
+
+
+def runTabCompare(command, timeout):
+    # run one TabCompare process, return its exit code, wall seconds, peak RSS in MB and stderr
+    with tempfile.TemporaryFile('w+') as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=errors)
+        # wait4 gives the resource use of this child alone, unlike RUSAGE_CHILDREN
+        deadline = time.monotonic() + timeout
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                process.kill()
+                pid, status, usage = os.wait4(process.pid, 0)
+                break
+            time.sleep(.005)
+        wall_seconds = time.perf_counter() - start
+        errors.seek(0)
+        return os.waitstatus_to_exitcode(status), wall_seconds, usage.ru_maxrss / 1024, errors.read()
+
+
+def runMode(name, variant, tabcompare_args, port_a, port_b, repeat, timeout):
+    runs = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_path = os.path.join(output_dir, 'out')
+        command = [sys.executable, '-X', 'importtime']
+        command += ['-c', EAGER_PRELUDE, TABCOMPARE] if variant == 'eager' else [TABCOMPARE]
+        command += ['--f', output_path, '--l', os.path.join(output_dir, 'logs', 'TabCompare'), '--ll', 'ERROR']
+        if '--role' not in tabcompare_args:
+            command += ['--sa', f'http://127.0.0.1:{port_a}', '--sb', f'http://127.0.0.1:{port_b}',
+                        '--u', 'bench', '--p', 'bench', '--nr', '0']
+        for _ in range(repeat):
+            if name == 'export':
+                # an artifact store with nothing in it
+                os.makedirs(os.path.join(output_path, 'objects'), exist_ok=True)
+            runs.append(runTabCompare(command + tabcompare_args, timeout))
+
+    exit_code = next((run[0] for run in runs if run[0]), 0)
+    if exit_code:
+        failed_output = next(run[3] for run in runs if run[0])
+        log_lines = [line for line in failed_output.splitlines() if not line.startswith('import time:')]
+        print(f'{name} ({variant}) failed with exit code {exit_code}:\n' + '\n'.join(log_lines[-40:]),
+              file=sys.stderr)
+    import_seconds = readImportTimes(runs[-1][3])
+    return {'mode': name,
+            'variant': variant,
+            'arguments': ' '.join(tabcompare_args),
+            'exit_code': exit_code,
+            'wall_seconds_median': float(np.median([run[1] for run in runs])),
+            'wall_seconds_min': min(run[1] for run in runs),
+            'peak_rss_mb': float(np.median([run[2] for run in runs])),
+            'imported': ','.join(sorted(import_seconds)) or '-',
+            'import_seconds': sum(import_seconds.values()),
+            'import_seconds_by_package': import_seconds}
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return f'{value:.3f}'
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TabCompare startup per mode, with lazy and eager imports')
+    parser.add_argument('--modes', nargs='*', choices=list(MODES), default=list(MODES),
+                        help='(optional) Mode combinations to run. Default: all')
+    parser.add_argument('--variants', nargs='*', choices=['lazy', 'eager'], default=['lazy', 'eager'],
+                        help='(optional) Import variants to run. Default: both')
+    parser.add_argument('--views', type=int, default=1,
+                        help='(optional) Views on each mock server, so the compares run. Default value: 1')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='(optional) Runs of each mode and variant, the medians are reported. Default value: 3')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='(optional) Seconds before a run is stopped. Default value: 120')
+    parser.add_argument('--output', help='(optional) Write the results to this JSON file')
+    args = parser.parse_args()
+
+    mock_args = ['--sites', '1', '--workbooks', '1', '--views', str(args.views)]
+    port_a, port_b = getFreePort(), getFreePort()
+    mock_a = startMockServer(port_a, mock_args)
+    mock_b = startMockServer(port_b, mock_args + ['--variant', 'b', '--csv-diff', '1'])
+    results = []
+    try:
+        for name in args.modes:
+            for variant in args.variants:
+                result = runMode(name, variant, MODES[name], port_a, port_b, args.repeat, args.timeout)
+                results.append(result)
+                print(' '.join(f'{key}={formatValue(value)}' for key, value in result.items()
+                               if key not in ('arguments', 'import_seconds_by_package')), flush=True)
+    finally:
+        mock_a.kill()
+        mock_b.kill()
+        mock_a.wait()
+        mock_b.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'settings': vars(args), 'results': results},
+                      f, indent=2)
+
+    # fail (for CI) when any run did
+    return 1 if any(result['exit_code'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
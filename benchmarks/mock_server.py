@@ -0,0 +1,239 @@
+#########################################################################################################
+# TabCompare mock Tableau Server
+# A local stand-in for the Tableau Server REST endpoints TabCompare uses: sign in/out, server info, sites,
+# workbooks, views, view image and view data. Used by the benchmarks, so no live server is needed.
+#
+# Example:
+#
+#   python benchmarks/mock_server.py --port 8001 --latency 0.2 --errors 0.05 --png-width 1600 --png-height 1200
+#
+#########################################################################################################
+
+import argparse
+import json
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+NAMESPACE = 'http://tableau.com/api'
+
+
+def makePng(width, height, seed):
+    # a noisy RGB PNG, the same for the same seed
+    rows = random.Random(seed).randbytes(width * height * 3)
+    raw = b''.join(b'\x00' + rows[row * width * 3:(row + 1) * width * 3] for row in range(height))
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b''))
+
+
+def makeCsv(rows, difference):
+    # summary data for a view; difference is added to the first row, so two servers can disagree
+    lines = ['Category,Region,Value'] + [f'C{row},R{row % 7},{row + (difference if row == 0 else 0)}'
+                                         for row in range(rows)]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+class Inventory(object):
+    # the sites, workbooks and views on the mock server. Ids only depend on the position of an item, so two mock
+    # servers with the same layout have the same content (and the same LUIDs)
+    def __init__(self, sites, workbooks, views):
+        self.sites = []
+        self.workbooks = []
+        self.views = []
+        for site_number in range(sites):
+            site = {'id': str(uuid.UUID(int=site_number + 1)),
+                    'name': 'Default' if site_number == 0 else f'Site{site_number}',
+                    'contentUrl': '' if site_number == 0 else f'site{site_number}'}
+            self.sites.append(site)
+            for workbook_number in range(workbooks):
+                workbook = {'id': str(uuid.UUID(int=(site_number + 1) * 1000 + workbook_number)),
+                            'name': f'Workbook{workbook_number}', 'contentUrl': f'Workbook{workbook_number}',
+                            'site': site['id'], 'project': 'Default' if workbook_number % 2 == 0 else 'Other'}
+                self.workbooks.append(workbook)
+                for view_number in range(views):
+                    self.views.append({'id': str(uuid.UUID(int=(site_number + 1) * 1000000 +
+                                                           workbook_number * 1000 + view_number)),
+                                       'name': f'View{view_number}',
+                                       'contentUrl': f'Workbook{workbook_number}/sheets/View{view_number}',
+                                       'workbook': workbook['id'], 'site': site['id']})
+
+
+def makeHandler(inventory, settings):
+    renders = {}  # (view id, endpoint) -> payload, so large PNGs are only encoded once
+    renders_lock = threading.Lock()
+
+    class MockTableauHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *log_args):
+            pass
+
+        def send(self, code, body=b'', content_type='application/xml'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def sendXml(self, inner, pagination=None):
+            pagination_xml = ''
+            if pagination:
+                pagination_xml = '<pagination pageNumber="%d" pageSize="%d" totalAvailable="%d"/>' % pagination
+            self.send(200, f'<?xml version="1.0" encoding="UTF-8"?><tsResponse xmlns="{NAMESPACE}">'
+                           f'{pagination_xml}{inner}</tsResponse>'.encode())
+
+        def page(self, items, query):
+            number = int(query.get('pageNumber', ['1'])[0])
+            size = int(query.get('pageSize', ['100'])[0])
+            return items[(number - 1) * size:number * size], (number, size, len(items))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            path = urlparse(self.path).path
+            if path.endswith('/auth/signin'):
+                if body.startswith(b'{'):
+                    content_url = json.loads(body)['credentials'].get('site', {}).get('contentUrl', '')
+                else:
+                    match = re.search(rb'contentUrl="([^"]*)"', body)
+                    content_url = match.group(1).decode() if match else ''
+                site = next((site for site in inventory.sites if content_url in (site['contentUrl'], site['name'])),
+                            None)
+                if site is None:
+                    return self.send(401, b'<error/>')
+                token = uuid.uuid4().hex
+                if 'json' in (self.headers.get('Accept') or ''):
+                    self.send(200, json.dumps({'credentials': {'token': token,
+                                                               'site': {'id': site['id'], 'contentUrl': content_url},
+                                                               'user': {'id': 'mockuser'}}}).encode(),
+                              'application/json')
+                else:
+                    self.sendXml(f'<credentials token="{token}"><site id="{site["id"]}" contentUrl="{content_url}"/>'
+                                 f'<user id="mockuser"/></credentials>')
+            elif path.endswith('/auth/signout'):
+                self.send(204)
+            else:
+                self.send(404)
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            query = parse_qs(parsed.query)
+            path = parsed.path
+            if path.lower().endswith('/serverinfo'):
+                return self.sendXml('<serverInfo><productVersion build="20231.0">2023.1</productVersion>'
+                                    '<restApiVersion>3.19</restApiVersion></serverInfo>')
+
+            match = re.match(r'.*/sites/([^/]+)/views/([^/]+)/(image|data)$', path)
+            if match:
+                return self.sendRender(match.group(2), match.group(3))
+
+            match = re.match(r'.*/sites/([^/]+)$', path)
+            if match and query.get('key') == ['name']:
+                site = next(site for site in inventory.sites if site['name'] == match.group(1))
+                return self.sendXml(self.siteXml(site))
+            if path.endswith('/sites'):
+                items, pagination = self.page(inventory.sites, query)
+                return self.sendXml('<sites>' + ''.join(self.siteXml(site) for site in items) + '</sites>',
+                                    pagination)
+
+            match = re.match(r'.*/sites/([^/]+)/workbooks/([^/]+)/views$', path)
+            if match:
+                views = [view for view in inventory.views if view['workbook'] == match.group(2)]
+                return self.sendXml('<views>' + ''.join(self.viewXml(view) for view in views) + '</views>')
+
+            match = re.match(r'.*/sites/([^/]+)/workbooks$', path)
+            if match:
+                workbooks = [workbook for workbook in inventory.workbooks if workbook['site'] == match.group(1)]
+                for workbook_filter in query.get('filter', []):
+                    field, _, value = workbook_filter.split(':', 2)
+                    key = 'name' if field == 'name' else 'project'
+                    workbooks = [workbook for workbook in workbooks if workbook[key] == value]
+                items, pagination = self.page(workbooks, query)
+                return self.sendXml('<workbooks>' + ''.join(self.workbookXml(workbook) for workbook in items) +
+                                    '</workbooks>', pagination)
+
+            match = re.match(r'.*/sites/([^/]+)/views$', path)
+            if match:
+                views = [view for view in inventory.views if view['site'] == match.group(1)]
+                items, pagination = self.page(views, query)
+                return self.sendXml('<views>' + ''.join(self.viewXml(view) for view in items) + '</views>',
+                                    pagination)
+            self.send(404)
+
+        def sendRender(self, view_id, endpoint):
+            time.sleep(max(0.0, random.gauss(settings.latency, settings.latency_jitter)))
+            if random.random() < settings.errors:
+                return self.send(500, b'<error/>')
+
+            with renders_lock:
+                if (view_id, endpoint) not in renders:
+                    if endpoint == 'image':
+                        renders[(view_id, endpoint)] = makePng(settings.png_width, settings.png_height,
+                                                               view_id + settings.variant)
+                    else:
+                        renders[(view_id, endpoint)] = makeCsv(settings.csv_rows, settings.csv_diff)
+            if endpoint == 'image':
+                self.send(200, renders[(view_id, endpoint)], 'image/png')
+            else:
+                self.send(200, renders[(view_id, endpoint)], 'text/csv')
+
+        def siteXml(self, site):
+            return (f'<site id="{site["id"]}" name="{site["name"]}" contentUrl="{site["contentUrl"]}" '
+                    f'adminMode="ContentAndUsers" state="Active"/>')
+
+        def viewXml(self, view):
+            return (f'<view id="{view["id"]}" name="{view["name"]}" contentUrl="{view["contentUrl"]}" '
+                    f'createdAt="2023-01-01T00:00:00Z" updatedAt="2023-01-02T00:00:00Z">'
+                    f'<workbook id="{view["workbook"]}"/><owner id="mockuser"/><project id="mockproject"/></view>')
+
+        def workbookXml(self, workbook):
+            return (f'<workbook id="{workbook["id"]}" name="{workbook["name"]}" contentUrl="{workbook["contentUrl"]}" '
+                    f'showTabs="true" size="1" createdAt="2023-01-01T00:00:00Z" updatedAt="2023-01-02T00:00:00Z">'
+                    f'<project id="mockproject" name="{workbook["project"]}"/><owner id="mockuser"/><tags/>'
+                    f'</workbook>')
+
+    return MockTableauHandler
+
+
+def getArgumentParser():
+    parser = argparse.ArgumentParser(description='Mock Tableau Server for TabCompare benchmarks')
+    parser.add_argument('--port', type=int, default=8001, help='(optional) Port to listen on. Default value: 8001')
+    parser.add_argument('--sites', type=int, default=2, help='(optional) Number of sites. Default value: 2')
+    parser.add_argument('--workbooks', type=int, default=2, help='(optional) Workbooks per site. Default value: 2')
+    parser.add_argument('--views', type=int, default=3, help='(optional) Views per workbook. Default value: 3')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='(optional) Mean seconds each view image/data request takes. Default value: 0')
+    parser.add_argument('--latency-jitter', type=float, default=0.0,
+                        help='(optional) Standard deviation of the render latency in seconds. Default value: 0')
+    parser.add_argument('--errors', type=float, default=0.0,
+                        help='(optional) Share (0-1) of view image/data requests that fail with HTTP 500. Default value: 0')
+    parser.add_argument('--png-width', type=int, default=64, help='(optional) Width of view images. Default value: 64')
+    parser.add_argument('--png-height', type=int, default=48,
+                        help='(optional) Height of view images. Default value: 48')
+    parser.add_argument('--csv-rows', type=int, default=20, help='(optional) Rows of view data. Default value: 20')
+    parser.add_argument('--variant', default='',
+                        help='(optional) Changes every view image. Give two servers different variants for image differences')
+    parser.add_argument('--csv-diff', type=int, default=0,
+                        help='(optional) Added to the first row of view data. Give two servers different values for data differences')
+    return parser
+
+
+def serve(settings):
+    # run a mock server until the process ends
+    inventory = Inventory(settings.sites, settings.workbooks, settings.views)
+    server = ThreadingHTTPServer(('127.0.0.1', settings.port), makeHandler(inventory, settings))
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve(getArgumentParser().parse_args())